@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
+from django.conf import settings
 
 
 class UserManager(BaseUserManager):
@@ -23,6 +26,32 @@ class UserManager(BaseUserManager):
         extra_fields.setdefault('is_superuser', False)
         return self.create_user(username, password, **extra_fields)
 
+    def add_usage(self, user_id, size, files=1, quota=None):
+        """
+        Add size bytes and files files to the user's usage counters in a single
+        UPDATE. With a quota, the update only happens if the new usage stays
+        within it; returns whether it happened.
+        """
+        users = self.filter(pk=user_id)
+        if quota is not None:
+            users = users.filter(used_bytes__lte=quota - size)
+        return users.update(used_bytes=F('used_bytes') + size, file_count=F('file_count') + files) == 1
+
+    def remove_usage(self, usage):
+        """Subtract usage[user_id] = (bytes, files) from each user's counters, never going below zero."""
+        if not usage:
+            return
+        self.filter(pk__in=usage).update(
+            used_bytes=Greatest(F('used_bytes') - Case(
+                *[When(pk=user_id, then=Value(size)) for user_id, (size, _) in usage.items()],
+                output_field=models.PositiveBigIntegerField()
+            ), Value(0)),
+            file_count=Greatest(F('file_count') - Case(
+                *[When(pk=user_id, then=Value(files)) for user_id, (_, files) in usage.items()],
+                output_field=models.PositiveIntegerField()
+            ), Value(0))
+        )
+
 
 class User(AbstractBaseUser):
     username = models.CharField(max_length=50, unique=True, blank=False)
@@ -31,6 +60,11 @@ class User(AbstractBaseUser):
     is_admin = models.BooleanField(default=False)
     is_superuser = models.BooleanField(default=False)
     storage_path = models.CharField(max_length=255)
+    # Denormalized totals over the user's files, kept up to date by File creation and deletion.
+    used_bytes = models.PositiveBigIntegerField(default=0)
+    file_count = models.PositiveIntegerField(default=0)
+    # Storage quota in bytes, None falls back to settings.FILES_DEFAULT_QUOTA.
+    quota_bytes = models.PositiveBigIntegerField(null=True, blank=True)
 
     USERNAME_FIELD = 'username'
 
@@ -38,3 +72,17 @@ class User(AbstractBaseUser):
 
     def __str__(self):
         return str(self.id)
+
+    @property
+    def quota(self):
+        """Storage quota in bytes, None when unlimited."""
+        if self.quota_bytes is not None:
+            return self.quota_bytes
+        return settings.FILES_DEFAULT_QUOTA or None
+
+    @property
+    def available_bytes(self):
+        """Bytes left before the quota is reached, None when unlimited."""
+        if self.quota is None:
+            return None
+        return max(self.quota - self.used_bytes, 0)
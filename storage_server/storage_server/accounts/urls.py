@@ -13,5 +13,6 @@ urlpatterns = [
     path('admin/create-user/', views.CreateUserAdminView.as_view(), name='admin-create-user'),
     path('admin/users/', views.AllUsersAdminView.as_view(), name='admin-users'),
     path('admin/users/get/', views.GetUsersAdminView.as_view(), name='admin-get-users'),
-    path('admin/users/<int:user_id>/', views.ChangeUserAdminView.as_view(), name='admin-change-user')
+    path('admin/users/<int:user_id>/', views.ChangeUserAdminView.as_view(), name='admin-change-user'),
+    path('admin/users/<int:user_id>/quota/', views.UserQuotaAdminView.as_view(), name='admin-user-quota')
 ]
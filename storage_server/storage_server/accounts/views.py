@@ -9,9 +9,14 @@ from django.contrib.auth.decorators import login_required
 from django.shortcuts import get_object_or_404
 from .models import User
 from ..files.models import File
-from django.db.models import Q
+from ..files.pagination import InvalidCursor, keyset_page, parse_page_size
+from ..files.serializers import FILE_LIST_FIELDS, file_list_data
+from ..files.workers import remove_files
+from django.db import transaction
+from django.db.models import F, Q
 from django.conf import settings
 import os
+from functools import partial
 from datetime import datetime, timedelta, timezone
 from ..logger import logger
 from django.shortcuts import render
@@ -177,6 +182,57 @@ class AllFilesAdminView(View):
         return render(request, 'index.html')
 
 
+# Admin file listings are sorted on (field, id) indexes, see File.Meta.indexes. username is the one exception:
+# it lives on the user, so that sort goes through the join.
+ADMIN_FILE_SORT_FIELDS = ('user_id', 'username', 'original_name', 'name', 'size', 'upload_date', 'last_download_date')
+
+ADMIN_FILE_FILTERS = ('user_id', 'username', 'original_name', 'name', 'size', 'upload_date', 'last_download_date')
+
+
+def admin_file_filters(params):
+    """
+    Collect file filters from ?filter=<field>&filter_value=<value>, as sent by the
+    admin page, and from ?<field>=<value> parameters, which can be combined.
+    """
+    filters = {field: params.get(field) for field in ADMIN_FILE_FILTERS if params.get(field)}
+    filter_field = params.get('filter')
+    if filter_field in ADMIN_FILE_FILTERS and params.get('filter_value'):
+        filters[filter_field] = params.get('filter_value')
+    return filters
+
+
+def admin_file_query(filters):
+    """Build a single Q object from the filters. Raises ValueError on malformed values."""
+    query = Q()
+    for field, value in filters.items():
+        if field == 'user_id':
+            if not value.isdigit():
+                raise ValueError('Invalid user_id')
+            query &= Q(user_id=int(value))
+        elif field == 'username':
+            query &= Q(user__username=value)
+        elif field == 'original_name':
+            query &= Q(original_name__icontains=value)
+        elif field == 'name':
+            query &= Q(name__icontains=value)
+        elif field == 'size':
+            if not value.isdigit():
+                raise ValueError('Invalid size')
+            query &= Q(size__gte=int(value) * 0.9) & Q(size__lte=int(value) * 1.1)
+        elif field in ('upload_date', 'last_download_date'):
+            query &= Q(**{f'{field}__gte': datetime.strptime(value, '%d.%m.%Y').replace(tzinfo=timezone.utc)})
+    return query
+
+
+def admin_file_list(query, sort_field):
+    """Values of the files matching query, including the column sort_field orders them by for keyset_page."""
+    field = sort_field.lstrip('-')
+    files = File.objects.filter(query)
+    if field == 'username':
+        files = files.annotate(username=F('user__username'))
+    return files.values(*FILE_LIST_FIELDS, *([field] if field not in FILE_LIST_FIELDS else []))
+
+
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class GetFilesAdminView(View):
     def get(self, request):
@@ -191,146 +247,45 @@ class GetFilesAdminView(View):
             logger.error('Sort parameter is required')
             return JsonResponse({'error': 'Sort parameter is required'}, status=400)
 
-        files = File.objects
-
-        filter_field = request.GET.get('filter')
-
-        if filter_field == 'user_id':
-            logger.debug('Filter = user_id case')
-            user_id = request.GET.get('filter_value')
-            if user_id and user_id.isdigit():
-                logger.debug('Getting files filtered by user_id...')
-                files = files.filter(user=user_id)
-                if files:
-                    logger.debug('Got files filtered by user_id')
-                else:
-                    logger.debug('Files not found by user_id')
-                    logger.debug('Getting user by user_id...')
-                    user = User.objects.get(id=user_id)
-                    if user:
-                        logger.debug('Got user')
-                        logger.debug('Setting files empty...')
-                        files = []
-                        logger.debug('Set files empty')
-                    else:
-                        logger.error('User not found')
-
-        elif filter_field == 'username':
-            logger.debug('Filter = username case')
-            username = request.GET.get('filter_value')
-            if username:
-                logger.debug('Getting user by username...')
-                user = User.objects.get(username=username)
-                if user:
-                    logger.debug('Got user by username')
-                    logger.debug('Getting files filtered by user_id...')
-                    files = files.filter(user=user.id)
-                else:
-                    logger.error('User not found')
-
-        elif filter_field == 'original_name':
-            logger.debug('Filter = original_name case')
-            original_name = request.GET.get('filter_value')
-            if original_name:
-                logger.debug('Getting files filtered by original_name(contains)...')
-                files = files.filter(original_name__icontains=original_name)
-                if files:
-                    logger.debug('Got files filtered by original_name')
-                else:
-                    logger.error('Files not found by original name')
-
-        elif filter_field == 'name':
-            logger.debug('Filter = name case')
-            name = request.GET.get('filter_value')
-            if name:
-                logger.debug('Getting files filtered by name(contains)...')
-                files = files.filter(name__icontains=name)
-                if files:
-                    logger.debug('Got files filtered by name')
-                else:
-                    logger.error('Files not found by name')
-
-        elif filter_field == 'size':
-            logger.debug('Filter = size case')
-            size = request.GET.get('filter_value')
-            if size and size.isdigit():
-                logger.debug('Getting files filtered by size(+-10%)...')
-                files = files.filter(Q(size__gte=int(size) * 0.9) & Q(size__lte=int(size) * 1.1))
-                if files:
-                    logger.debug('Got files filtered by size')
-                else:
-                    logger.error('Files not found by size')
-
-        elif filter_field == 'upload_date':
-            logger.debug('Filter = upload_date case')
-            upload_date = request.GET.get('filter_value')
-            if upload_date:
-                try:
-                    logger.debug('Getting files filtered by upload_date...')
-                    upload_date = datetime.strptime(upload_date, '%d.%m.%Y')
-                    files = files.filter(upload_date__gte=upload_date)
-                except ValueError:
-                    logger.error('Invalid upload_date format')
-                if files:
-                    logger.debug('Got files filtered by upload_date')
-                else:
-                    logger.error('Files not found by upload_date')
-
-        elif filter_field == 'last_download_date':
-            logger.debug('Filter = last_download_date case')
-            last_download_date = request.GET.get('filter_value')
-            if last_download_date:
-                try:
-                    logger.debug('Getting files filtered by last_download_date...')
-                    last_download_date = datetime.strptime(last_download_date, '%d.%m.%Y')
-                    files = files.filter(last_download_date__gte=last_download_date)
-                except ValueError:
-                    logger.error('Invalid upload_date format')
-                if files:
-                    logger.debug('Got files filtered by last_download_date')
-                else:
-                    logger.error('Files not found by last_download_date')
-        else:
-            logger.debug('No filter case')
-            logger.debug('Getting current_date(utc)...')
-            current_date = datetime.now(timezone.utc)
-            logger.debug('Got current_date')
-            logger.debug('Getting start_date(utc)...')
-            start_date = current_date - timedelta(days=1)
-            logger.debug('Got current_date')
-            logger.debug('Getting files filtered by upload_date < 1day...')
-            files = files.filter(upload_date__gte=start_date)
-            if files:
-                logger.debug('Got files filtered by last_download_date')
-            else:
-                logger.debug('Files not found by last_download_date')
-                logger.debug('Exiting AllFilesAdminView.get function and responding '
-                             'with "files": files (empty)')
-                file_list = []
-                return JsonResponse({'files': file_list})
-
-        if files:
-            logger.debug('Starting files order_by sort_filed...')
-            files = files.order_by(sort_field)
-            logger.debug('Finished files order_by sort_filed')
+        if sort_field.lstrip('-') not in ADMIN_FILE_SORT_FIELDS:
+            logger.error('Invalid sort parameter')
+            return JsonResponse({'error': 'Invalid sort parameter'}, status=400)
+
+        try:
+            limit = parse_page_size(request.GET.get('limit'))
+        except ValueError:
+            logger.error('Invalid limit parameter')
+            return JsonResponse({'error': 'Invalid limit parameter'}, status=400)
+
+        filters = admin_file_filters(request.GET)
+        logger.debug('Building files query for filters %s...', filters)
+        try:
+            query = admin_file_query(filters)
+        except ValueError as e:
+            logger.error('Invalid filter value: %s', e)
+            return JsonResponse({'error': 'Invalid filter value'}, status=400)
+
+        if not filters:
+            logger.debug('No filter case, getting files uploaded within the last day')
+            query = Q(upload_date__gte=datetime.now(timezone.utc) - timedelta(days=1))
+        logger.debug('Built files query')
+
+        logger.debug('Getting files page...')
+        try:
+            files, next_cursor = keyset_page(admin_file_list(query, sort_field), sort_field, request.GET.get('cursor'),
+                                             limit)
+        except InvalidCursor:
+            logger.error('Invalid cursor')
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        logger.debug('Got files page')
 
         logger.debug('Starting file_list preparation...')
-        file_list = []
-        for file in files:
-            file_data = {
-                'id': file.id,
-                'name': file.name,
-                'comment': file.comment,
-                'size': file.size,
-                'upload_date': str(file.upload_date),
-                'last_download_date': str(file.last_download_date)
-            }
-            file_list.append(file_data)
+        file_list = [file_list_data(file) for file in files]
         logger.debug('Finished file_list preparation')
 
-        logger.debug('Exiting AllFilesAdminView.get function and  responding '
+        logger.debug('Exiting GetFilesAdminView.get function and responding '
                      'with "files": file_list')
-        return JsonResponse({'files': file_list})
+        return JsonResponse({'files': file_list, 'next_cursor': next_cursor})
 
 
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
@@ -411,17 +366,29 @@ class ChangeUserAdminView(View):
         if not (request.user.is_admin or request.user.is_superuser):
             logger.error('Access denied')
             return JsonResponse({'error': 'Access denied'}, status=403)
-        logger.debug('Getting user by id...')
-        user = get_object_or_404(User, id=user_id)
+        # The user row is locked first, as uploads lock it, so no file or session can be added
+        # between deleting them and deleting the user, which would cascade without releasing them.
+        with transaction.atomic():
+            logger.debug('Getting user by id...')
+            user = get_object_or_404(User.objects.select_for_update(), id=user_id)
 
-        if user.is_superuser:
-            if not request.user.is_superuser:
-                logger.error('Access denied')
-                return JsonResponse({'error': 'Access denied'}, status=403)
-        logger.debug('Got user by id')
-        logger.debug('Deleting user...')
-        user.delete()
-        logger.debug('Deleted user')
+            if user.is_superuser:
+                if not request.user.is_superuser:
+                    logger.error('Access denied')
+                    return JsonResponse({'error': 'Access denied'}, status=403)
+            logger.debug('Got user by id')
+            logger.debug('Deleting user files...')
+            File.objects.delete_files(user.files.values_list('id', flat=True))
+            logger.debug('Deleted user files')
+            logger.debug('Deleting user upload sessions...')
+            sessions = user.upload_sessions.all()
+            temp_paths = [session.temp_path for session in sessions.only('id')]
+            sessions.delete()
+            transaction.on_commit(partial(remove_files, temp_paths))
+            logger.debug('Deleted user upload sessions')
+            logger.debug('Deleting user...')
+            user.delete()
+            logger.debug('Deleted user')
 
         logger.debug('Exiting ChangeUserAdminView.delete function and responding '
                      'with "message": "User deleted successfully"')
@@ -443,6 +410,35 @@ class ChangeUserAdminView(View):
         return JsonResponse({'message': 'User rights updated successfully'})
 
 
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class UserQuotaAdminView(View):
+    def patch(self, request, user_id):
+        logger.debug('Entering UserQuotaAdminView.patch function')
+        if not (request.user.is_admin or request.user.is_superuser):
+            logger.error('Access denied')
+            return JsonResponse({'error': 'Access denied'}, status=403)
+        data = json.loads(request.body)
+        if 'quota_bytes' not in data:
+            logger.error('quota_bytes not provided')
+            return JsonResponse({'error': 'quota_bytes not provided'}, status=400)
+        quota_bytes = data['quota_bytes']
+        if quota_bytes is not None and (not isinstance(quota_bytes, int) or quota_bytes < 0):
+            logger.error('Invalid quota_bytes')
+            return JsonResponse({'error': 'quota_bytes must be a non-negative integer or null'}, status=400)
+
+        logger.debug('Getting user by id...')
+        user = get_object_or_404(User.objects.only('id'), id=user_id)
+        logger.debug('Got user by id')
+        logger.debug('Setting user.quota_bytes...')
+        user.quota_bytes = quota_bytes
+        user.save(update_fields=['quota_bytes'])
+        logger.debug('Set user.quota_bytes')
+
+        logger.debug('Exiting UserQuotaAdminView.patch function and responding '
+                     'with "message": "User quota updated successfully"')
+        return JsonResponse({'message': 'User quota updated successfully'})
+
+
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class GetUsersAdminView(View):
     def get(self, request):
@@ -465,6 +461,9 @@ class GetUsersAdminView(View):
                 'email': user.email,
                 'is_admin': 'Yes' if user.is_admin else 'No',
                 'is_superuser': 'Yes' if user.is_superuser else 'No',
+                'used_bytes': user.used_bytes,
+                'file_count': user.file_count,
+                'quota_bytes': user.quota,
             }
             user_list.append(user_data)
         logger.debug('Finished writing user_data to user_list')
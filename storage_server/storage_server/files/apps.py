@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class FilesConfig(AppConfig):
+    name = 'storage_server.files'
+    label = 'files'
+
+    def ready(self):
+        from .compression import storage_encoding
+        from .search import create_trigram_indexes
+        post_migrate.connect(create_trigram_indexes, sender=self)
+        # Fails at startup rather than on the first upload when the configured compression is unavailable.
+        storage_encoding()
@@ -0,0 +1,80 @@
+import os
+import zipfile
+
+from ..logger import logger
+
+CHUNK_SIZE = 256 * 2 ** 10
+
+# Formats that are already compressed and would only waste CPU if deflated again.
+COMPRESSED_EXTENSIONS = frozenset((
+    '7z', 'aac', 'apk', 'avi', 'br', 'bz2', 'docx', 'epub', 'flac', 'gif', 'gz', 'heic', 'jar', 'jpeg', 'jpg',
+    'm4a', 'm4v', 'mkv', 'mov', 'mp3', 'mp4', 'odp', 'ods', 'odt', 'ogg', 'opus', 'png', 'pptx', 'rar', 'tgz',
+    'webm', 'webp', 'xlsx', 'xz', 'zip', 'zst'
+))
+
+
+class ZipOutput:
+    """
+    Write-only, unseekable sink for ZipFile. zipfile then writes every entry with a
+    trailing data descriptor, so nothing has to be revisited and the archive can be
+    sent as it is produced.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def compress_type_for(name):
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    return zipfile.ZIP_STORED if extension in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def unique_archive_names(files):
+    """Yield (archive name, file) pairs, suffixing names that repeat with ' (n)'."""
+    seen = set()
+    for file in files:
+        name = file.original_name
+        stem, extension = os.path.splitext(name)
+        counter = 1
+        while name in seen:
+            name = f'{stem} ({counter}){extension}'
+            counter += 1
+        seen.add(name)
+        yield name, file
+
+
+def iter_zip(files, on_file_done=None):
+    """
+    Stream a ZIP archive of files, at most CHUNK_SIZE of file data at a time, so
+    memory use stays constant regardless of the number and size of files.
+    Entries of 4 GiB and more use ZIP64 records.
+    """
+    output = ZipOutput()
+    with zipfile.ZipFile(output, 'w', allowZip64=True) as archive:
+        for name, file in unique_archive_names(files):
+            info = zipfile.ZipInfo(name, date_time=file.upload_date.timetuple()[:6])
+            info.compress_type = compress_type_for(name)
+            info.external_attr = 0o644 << 16
+            logger.debug('Adding %s to archive', name)
+            with file.open() as source, archive.open(info, 'w', force_zip64=file.size >= zipfile.ZIP64_LIMIT) as entry:
+                while chunk := source.read(CHUNK_SIZE):
+                    entry.write(chunk)
+                    data = output.pop()
+                    if data:
+                        yield data
+            yield output.pop()
+            if on_file_done:
+                on_file_done(file)
+    yield output.pop()
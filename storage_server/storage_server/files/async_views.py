@@ -0,0 +1,146 @@
+"""
+Async versions of the upload and download views, used in place of the sync ones
+when FILES_ASYNC_VIEWS is enabled and the project is served over ASGI
+(e.g. uvicorn storage_server.asgi:application).
+
+A transfer then holds no thread while waiting on a slow client: response
+bodies are async iterators whose file reads run in worker threads, and the
+upload's multipart parsing, hashing and moving into the blob store run in a
+worker thread too. Django's ASGI handler receives the whole request body
+(spooled to a temporary file past FILE_UPLOAD_MAX_MEMORY_SIZE) before calling
+the view, so a slow upload only costs the event loop, not a worker.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.decorators import login_required
+from django.db import IntegrityError
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import render
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from ..logger import logger
+from .models import File, QuotaExceeded, blob_temp_directory
+from .serving import counts_as_download, serve_file
+from .stats import download_stats
+from .uploads import StreamingFileUploadHandler, upload_exceeds_quota
+
+
+def parse_body(request):
+    return request.POST, request.FILES
+
+
+async def aget_file(**lookup):
+    try:
+        return await File.objects.select_related('blob').aget(**lookup)
+    except File.DoesNotExist:
+        raise Http404('File not found')
+
+
+# login_required has to wrap the handlers themselves: on dispatch it would take
+# the sync code path and load the user from the event loop.
+@method_decorator(csrf_exempt, name='dispatch')
+@method_decorator(login_required(login_url='/login/'), name='get')
+@method_decorator(login_required(login_url='/login/'), name='post')
+class AsyncUploadView(View):
+    async def get(self, request):
+        logger.debug('Entering AsyncUploadView.get function')
+        logger.debug('Exiting AsyncUploadView.get function and rendering page')
+        return render(request, 'index.html')
+
+    async def post(self, request):
+        logger.debug('Entering AsyncUploadView.post function')
+        user = await request.auser()
+        if upload_exceeds_quota(request, user):
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+        request.upload_handlers = [
+            StreamingFileUploadHandler(request, blob_temp_directory(), max_size=user.available_bytes)
+        ]
+        logger.debug('Parsing request body...')
+        await asyncio.to_thread(parse_body, request)
+        logger.debug('Parsed request body')
+        # The CSRF check reads request.POST, which is only safe once it has been parsed off the event loop.
+        return await csrf_protect(self.create_file)(request)
+
+    async def create_file(self, request):
+        user = await request.auser()
+        file = request.FILES.get('file')
+        comment = request.POST.get('comment')
+
+        if request.upload_handlers[0].quota_exceeded:
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+
+        if not file:
+            logger.error('No file provided')
+            return HttpResponseBadRequest(json.dumps({'error': 'No file provided'}), content_type='application/json')
+
+        if not comment:
+            logger.debug('Empty comment')
+            comment = ''
+
+        if await File.objects.filter(user=user, original_name=file.name).aexists():
+            await asyncio.to_thread(file.discard)
+            logger.error('File with this name already exists')
+            return HttpResponseBadRequest(json.dumps({'error': 'File with this name already exists'}),
+                                          content_type='application/json')
+
+        logger.debug('Creating uploaded file: user=%s, original_name=%s, size=%s, sha256=%s...',
+                     user, file.name, file.size, file.sha256)
+        file.close()
+        try:
+            await sync_to_async(File.objects.create_from_temp)(user, file.name, comment, file.temporary_file_path(),
+                                                               file.sha256, file.size, file.content_encoding)
+        except QuotaExceeded:
+            await asyncio.to_thread(file.discard)
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+        except IntegrityError:
+            await asyncio.to_thread(file.discard)
+            logger.error('File with this name already exists')
+            return HttpResponseBadRequest(json.dumps({'error': 'File with this name already exists'}),
+                                          content_type='application/json')
+        logger.debug('Created uploaded file and saved it to DB')
+
+        logger.debug('Exiting AsyncUploadView.post function'
+                     ' and responding with "message": "File uploaded successfully"')
+        return JsonResponse({'message': 'File uploaded successfully'})
+
+
+@method_decorator(login_required(login_url='/login/'), name='get')
+class AsyncDownloadView(View):
+    async def get(self, request, file_id):
+        logger.debug('Entering AsyncDownloadView.get function')
+        user = await request.auser()
+        file = await aget_file(id=file_id)
+
+        if file.user_id != user.id and not (user.is_admin or user.is_superuser):
+            logger.error('Access denied')
+            return JsonResponse({'error': 'Access denied'}, status=403)
+
+        response = await asyncio.to_thread(serve_file, request, file, asynchronous=True)
+        if counts_as_download(request, response, file.size):
+            download_stats.record(file.id)
+
+        logger.debug('Exiting AsyncDownloadView.get function and streaming file')
+        return response
+
+
+class AsyncDownloadSpecialView(View):
+    async def get(self, request, file_id, token):
+        logger.debug('Entering AsyncDownloadSpecialView.get function')
+        file = await aget_file(share_token=token)
+        if file_id != file.id:
+            logger.error('Share token does not match file id')
+            raise Http404('File not found')
+
+        response = await asyncio.to_thread(serve_file, request, file, asynchronous=True)
+        if counts_as_download(request, response, file.size):
+            download_stats.record(file.id)
+
+        logger.debug('Exiting AsyncDownloadSpecialView.get function and streaming file')
+        return response
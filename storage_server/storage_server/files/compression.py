@@ -0,0 +1,76 @@
+import gzip
+import os
+import zlib
+
+import filetype
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .archive import COMPRESSED_EXTENSIONS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODING_GZIP = 'gzip'
+ENCODING_ZSTD = 'zstd'
+
+COMPRESSION_OFF = 'off'
+COMPRESSION_AUTO = 'auto'
+
+CHUNK_SIZE = 256 * 2 ** 10
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def storage_encoding():
+    """The encoding new blobs are compressed with per settings.FILES_COMPRESSION, None when compression is off."""
+    mode = settings.FILES_COMPRESSION
+    if mode == COMPRESSION_OFF:
+        return None
+    if mode == COMPRESSION_AUTO:
+        return ENCODING_ZSTD if zstandard else ENCODING_GZIP
+    if mode == ENCODING_ZSTD and not zstandard:
+        raise ImproperlyConfigured('FILES_COMPRESSION is zstd but zstandard is not installed, '
+                                   'see requirements-zstd.txt')
+    return mode
+
+
+def compressor(encoding):
+    """Streaming compressor with compress(data) and flush() methods for encoding."""
+    if encoding == ENCODING_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def open_decoded(f, encoding):
+    """Wrap the stored file f of a compressed blob for reading its original content. Seeking forward is supported."""
+    if encoding == ENCODING_ZSTD:
+        if not zstandard:
+            f.close()
+            raise RuntimeError(f'zstandard is required to read {f.name}')
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    decoded = gzip.GzipFile(fileobj=f, mode='rb')
+    # GzipFile only closes file objects it opened itself, the ones it keeps in myfileobj.
+    decoded.myfileobj = f
+    return decoded
+
+
+def worth_compressing(name, sample):
+    """
+    Whether content starting with sample is worth compressing: not a known
+    compressed format by name or magic number, and the sample shrinks by at
+    least FILES_COMPRESSION_MIN_SAVING when compressed at the fastest level.
+    """
+    if not sample:
+        return False
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    if extension in COMPRESSED_EXTENSIONS:
+        return False
+    if filetype.is_archive(sample) or filetype.is_video(sample) or filetype.is_audio(sample):
+        return False
+    compressed_size = len(zlib.compress(sample, 1))
+    return compressed_size <= len(sample) * (1 - settings.FILES_COMPRESSION_MIN_SAVING)
+
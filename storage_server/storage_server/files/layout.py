@@ -0,0 +1,18 @@
+import os
+
+from django.conf import settings
+
+
+def shard_directories(key):
+    """
+    The fan-out directories for key, a hex digest: FILES_SHARD_DEPTH levels
+    named after successive FILES_SHARD_WIDTH character prefixes of key, so no
+    single directory grows past 16 ** FILES_SHARD_WIDTH entries per level.
+    """
+    width = settings.FILES_SHARD_WIDTH
+    return [key[level * width:(level + 1) * width] for level in range(settings.FILES_SHARD_DEPTH)]
+
+
+def sharded_path(directory, key, suffix=''):
+    """Path relative to MEDIA_ROOT of the entry for key in directory under the configured fan-out layout."""
+    return os.path.join(directory, *shard_directories(key), key + suffix)
@@ -0,0 +1,50 @@
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import File, new_share_token
+
+LEGACY_SPECIAL_LINK_RE = re.compile(r'^/files/(\d+)/download/([^/]{1,64})/$')
+
+
+def legacy_share_token(file):
+    """The token of the share link file had before share tokens existed, None if it had none."""
+    match = LEGACY_SPECIAL_LINK_RE.match(file.legacy_special_link or '')
+    if match and int(match.group(1)) == file.id:
+        return match.group(2)
+    return None
+
+
+class Command(BaseCommand):
+    help = ('Give files created before share tokens existed a share token, in small batches. Files keep the '
+            'token of the share link they already had, so links handed out before keep working; only files '
+            'without one get a new token.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of rows updated per batch (default: 1000)')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit database load')
+
+    def handle(self, *args, **options):
+        updated = 0
+        kept = 0
+        while True:
+            batch = list(File.objects.filter(share_token__isnull=True).only('id', 'legacy_special_link')
+                         [:options['batch_size']])
+            if not batch:
+                break
+            for file in batch:
+                file.share_token = legacy_share_token(file)
+                if file.share_token:
+                    kept += 1
+                else:
+                    file.share_token = new_share_token()
+            File.objects.bulk_update(batch, ['share_token'])
+            updated += len(batch)
+            self.stdout.write(f'Updated {updated} files')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'Done, updated {updated} files, {kept} of them kept their share link'))
@@ -0,0 +1,96 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ...models import File
+from ...search import search_files, trigram_available
+from ....accounts.models import User
+
+WORDS = ('report', 'invoice', 'photo', 'backup', 'draft', 'final', 'budget', 'contract', 'notes', 'scan',
+         'presentation', 'archive', 'summary', 'export', 'design', 'meeting', 'holiday', 'project', 'data', 'log')
+
+EXTENSIONS = ('pdf', 'docx', 'xlsx', 'png', 'jpg', 'txt', 'csv', 'zip', 'mp4', 'json')
+
+QUERIES = ('invoice', 'budget 2023', 'reprot', 'photo_0', 'contract final', '.csv', 'meeting notes', 'xyzzy')
+
+BENCH_USERNAME = 'bench-search'
+
+
+class Command(BaseCommand):
+    help = ('Measure file name search latency. Seeds synthetic File rows owned by a dedicated '
+            f'"{BENCH_USERNAME}" user until the table holds --rows rows, then times every sample query '
+            'with the trigram search, a plain icontains match and, on PostgreSQL, icontains '
+            'with index scans disabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000,
+                            help='Minimum number of File rows to search over (default: 1000000)')
+        parser.add_argument('--repeat', type=int, default=20, help='Runs per query (default: 20)')
+        parser.add_argument('--limit', type=int, default=50, help='Results fetched per query (default: 50)')
+        parser.add_argument('--batch-size', type=int, default=10_000, help='Rows inserted per bulk_create')
+        parser.add_argument('--cleanup', action='store_true', help=f'Delete the {BENCH_USERNAME} user and its rows')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            File.objects.filter(user__username=BENCH_USERNAME).delete()
+            User.objects.filter(username=BENCH_USERNAME).delete()
+            self.stdout.write(self.style.SUCCESS('Removed benchmark rows'))
+            return
+
+        self.seed(options['rows'], options['batch_size'])
+        modes = ('search', 'icontains')
+        if connection.vendor == 'postgresql':
+            modes += ('seqscan',)
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {File._meta.db_table}')
+
+        self.stdout.write(f'pg_trgm available: {trigram_available()}')
+        self.stdout.write(f'{"query":<20} {"mode":<10} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9} {"hits":>6}')
+        for query in QUERIES:
+            for mode in modes:
+                timings, hits = self.measure(query, mode, options['repeat'], options['limit'])
+                self.stdout.write(f'{query:<20} {mode:<10} {self.percentile(timings, 50):>9.2f} '
+                                  f'{self.percentile(timings, 95):>9.2f} {max(timings):>9.2f} {hits:>6}')
+
+    def seed(self, rows, batch_size):
+        missing = rows - File.objects.count()
+        if missing <= 0:
+            return
+        user, _ = User.objects.get_or_create(username=BENCH_USERNAME, defaults={'email': f'{BENCH_USERNAME}@localhost'})
+        offset = File.objects.filter(user=user).count()
+        self.stdout.write(f'Seeding {missing} File rows...')
+        rng = random.Random(offset)
+        for start in range(offset, offset + missing, batch_size):
+            batch = []
+            for i in range(start, min(start + batch_size, offset + missing)):
+                name = f'{rng.choice(WORDS)}_{rng.choice(WORDS)}_{i}.{rng.choice(EXTENSIONS)}'
+                batch.append(File(user=user, original_name=name, name=name, size=rng.randint(1, 2 ** 30),
+                                  comment='', path=f'bench/{i}', sha256=''))
+            File.objects.bulk_create(batch)
+            self.stdout.write(f'  {start + len(batch) - offset}/{missing}')
+
+    def measure(self, query, mode, repeat, limit):
+        timings = []
+        hits = 0
+        for _ in range(repeat):
+            with transaction.atomic():
+                if mode == 'seqscan':
+                    # The icontains query as it ran before the trigram indexes existed.
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_bitmapscan = off')
+                        cursor.execute('SET LOCAL enable_indexscan = off')
+                started = time.perf_counter()
+                if mode == 'search':
+                    hits = len(list(search_files(File.objects.values('id', 'name'), query, limit)))
+                else:
+                    hits = len(list(File.objects.filter(name__icontains=query).values('id', 'name')
+                                    .order_by('name', 'id')[:limit]))
+                timings.append((time.perf_counter() - started) * 1000)
+        return timings, hits
+
+    @staticmethod
+    def percentile(values, percent):
+        return statistics.quantiles(values, n=100, method='inclusive')[percent - 1] if len(values) > 1 else values[0]
@@ -0,0 +1,99 @@
+import copy
+import logging.config
+import os
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from ....accounts.models import User
+
+BENCH_USERNAME = 'bench-logging'
+
+# name: (description, logger level, use the queue handler, debug sample rate)
+SETUPS = {
+    'off': ('no logging at all', 'CRITICAL', True, 1.0),
+    'sync': ('DEBUG written by synchronous file and console handlers (previous setup)', 'DEBUG', False, 1.0),
+    'queue': ('DEBUG written from the background queue listener', 'DEBUG', True, 1.0),
+    'sampled': ('DEBUG for 1% of requests, from the queue listener', 'DEBUG', True, 0.01),
+    'info': ('INFO, the production default, from the queue listener', 'INFO', True, 1.0),
+}
+
+
+class Command(BaseCommand):
+    help = ('Measure the per-request cost of logging. Requests the file listing in-process through the test '
+            'client under each logging setup, writing logs to temporary files, and reports latencies '
+            'and the overhead over running without logging.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per setup (default: 2000)')
+        parser.add_argument('--path', default='/files/get/', help='Path requested (default: /files/get/)')
+        parser.add_argument('--rounds', type=int, default=10, help='Turns each setup gets (default: 10)')
+        parser.add_argument('--setups', nargs='+', choices=SETUPS, default=list(SETUPS))
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username=BENCH_USERNAME, defaults={'email': f'{BENCH_USERNAME}@localhost'})
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+
+        results = {name: [] for name in options['setups']}
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                # Setups take turns in rounds so drift in machine load affects them all alike.
+                for _ in range(options['rounds']):
+                    for name in options['setups']:
+                        results[name] += self.run_setup(name, directory, user, host, options['path'],
+                                                        options['requests'] // options['rounds'])
+            finally:
+                logging.config.dictConfig(settings.LOGGING)
+
+        baseline = statistics.fmean(results['off']) if 'off' in results else None
+        self.stdout.write(f'{"setup":<9} {"mean us":>9} {"p50 us":>9} {"p99 us":>9} {"overhead us":>12}  description')
+        for name, timings in results.items():
+            mean = statistics.fmean(timings)
+            overhead = f'{mean - baseline:>12.1f}' if baseline is not None else f'{"":>12}'
+            self.stdout.write(f'{name:<9} {mean:>9.1f} {self.percentile(timings, 50):>9.1f} '
+                              f'{self.percentile(timings, 99):>9.1f} {overhead}  {SETUPS[name][0]}')
+
+    def run_setup(self, name, directory, user, host, path, requests):
+        _, level, queued, rate = SETUPS[name]
+        with open(os.path.join(directory, f'{name}.console'), 'a') as console:
+            logging.config.dictConfig(self.logging_config(level, queued, directory, name, console))
+            try:
+                with override_settings(LOG_DEBUG_SAMPLE_RATE=rate):
+                    client = Client(HTTP_HOST=host)
+                    client.force_login(user)
+                    return self.measure(client, path, requests)
+            finally:
+                # Closing the handlers drains the queue before the next setup starts.
+                logging.config.dictConfig({'version': 1, 'disable_existing_loggers': False})
+
+    @staticmethod
+    def logging_config(level, queued, directory, name, console):
+        config = copy.deepcopy({key: value for key, value in settings.LOGGING.items() if key != 'handlers'})
+        config['handlers'] = copy.deepcopy(settings.LOGGING['handlers'])
+        config['handlers']['file']['filename'] = os.path.join(directory, f'{name}.log')
+        config['handlers']['console']['stream'] = console
+        for handler in ('file', 'console'):
+            config['handlers'][handler]['level'] = 'DEBUG'
+        config['loggers']['storage_server']['level'] = level
+        if not queued:
+            config['loggers']['storage_server']['handlers'] = ['file', 'console']
+        return config
+
+    @staticmethod
+    def measure(client, path, requests):
+        client.get(path)
+        timings = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = client.get(path)
+            timings.append((time.perf_counter() - started) * 1_000_000)
+            assert response.status_code == 200, response.status_code
+        return timings
+
+    @staticmethod
+    def percentile(values, percent):
+        return statistics.quantiles(values, n=100, method='inclusive')[percent - 1]
@@ -0,0 +1,392 @@
+import glob
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import secrets
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode, urlsplit
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from .bench_file_search import WORDS
+from .bench_transfers import parse_size, session_cookie
+from .generate_dataset import DEFAULT_PASSWORD, DEFAULT_PREFIX, dataset_usernames
+from ...models import File
+from ...views import FILE_LIST_SORT_FIELDS
+from ....accounts.models import User
+from ....accounts.views import ADMIN_FILE_SORT_FIELDS
+
+SCENARIOS = ('login', 'upload_small', 'upload_large', 'download', 'share', 'list', 'admin_list')
+
+# Scenarios that move a file per request run --large-requests requests instead of --requests.
+LARGE_SCENARIOS = ('upload_large',)
+
+# Files sampled from the dataset for the download and share scenarios.
+DOWNLOAD_SAMPLE = 1000
+
+
+def percentile(values, percent):
+    return statistics.quantiles(values, n=100, method='inclusive')[percent - 1] if len(values) > 1 else values[0]
+
+
+def process_tree(pid):
+    """pid and the pids of all its descendants, such as the workers of a gunicorn master."""
+    pids = [pid]
+    for children in glob.glob(f'/proc/{pid}/task/*/children'):
+        try:
+            with open(children) as f:
+                for child in f.read().split():
+                    pids.extend(process_tree(int(child)))
+        except OSError:
+            pass
+    return pids
+
+
+def reset_peak_rss(pids):
+    """Reset the peak RSS the kernel tracks for pids to their current RSS, where permitted."""
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            pass
+
+
+def peak_rss(pids):
+    """Peak resident set size in bytes of each of pids that is still running, from /proc/<pid>/status."""
+    peaks = {}
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peaks[pid] = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return peaks
+
+
+class Request:
+    """
+    A scripted request. body, if any, is called for every request sent and
+    returns an iterable of bytes, its length and headers to add.
+    """
+
+    def __init__(self, method, path, headers=None, body=None, expected=(200,)):
+        self.method = method
+        self.path = path
+        self.headers = headers or {}
+        self.body = body
+        self.expected = expected
+
+
+class Command(BaseCommand):
+    help = ('Run the benchmark scenarios against a running server and report throughput, p50/p99 latency and '
+            'peak RSS as JSON, for catching performance regressions. Generate the data first with the '
+            'generate_dataset command; this command has to use the same database and MEDIA_ROOT as the '
+            'server, as it picks files from the dataset and logs users in by creating their sessions '
+            'directly. For numbers that compare with production, run everything against PostgreSQL, in a '
+            'container (docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=bench postgres:16, then '
+            'DB_HOST=127.0.0.1 DB_PORT=5432 DB_NAME=postgres DB_USER=postgres DB_PASSWORD=bench) or on localhost, with '
+            'migrate, generate_dataset, the server (gunicorn storage_server.wsgi) and this command all using '
+            'the same environment. Pass the server pid with --server-pid to measure the peak RSS of it and '
+            'its workers, and a previous report with --baseline to fail when a scenario got slower.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server base URL')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help='Scenario to run, may be repeated (default: all)')
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario (default: 500)')
+        parser.add_argument('--large-requests', type=int, default=20,
+                            help=f'Requests for {", ".join(LARGE_SCENARIOS)} (default: 20)')
+        parser.add_argument('--warmup', type=int, default=20,
+                            help='Unrecorded requests sent before each scenario (default: 20)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous clients (default: 8)')
+        parser.add_argument('--small-size', default='16K', help='Bytes per small upload (default: 16K)')
+        parser.add_argument('--large-size', default='64M',
+                            help='Bytes per large upload, and the largest file downloaded (default: 64M)')
+        parser.add_argument('--prefix', default=DEFAULT_PREFIX,
+                            help=f'Username prefix the dataset was generated with (default: {DEFAULT_PREFIX})')
+        parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                            help=f'Password the dataset was generated with (default: {DEFAULT_PASSWORD})')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for picking requests (default: 0)')
+        parser.add_argument('--timeout', type=float, default=300, help='Seconds before a request is abandoned')
+        parser.add_argument('--server-pid', type=int, action='append', default=[],
+                            help='Pid of the server, whose peak RSS is reported together with its '
+                                 'children; may be repeated')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--baseline', help='Earlier JSON report to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Fraction by which throughput may drop or p99 latency grow against '
+                                 '--baseline before the command fails (default: 0.2)')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError('Only http:// URLs are supported')
+        self.options = options
+        self.url = url
+        self.rng = random.Random(options['seed'])
+        self.run_id = secrets.token_hex(4)
+
+        user_prefix, admin_username = dataset_usernames(options['prefix'])
+        # The users with the most files, so listings return full pages.
+        self.users = list(User.objects.filter(username__startswith=user_prefix)
+                          .order_by('-file_count', 'id')[:max(options['concurrency'], 1)])
+        self.admin = User.objects.filter(username=admin_username).first()
+        if not self.users or not self.admin:
+            raise CommandError(f'No dataset with prefix {options["prefix"]!r}, run generate_dataset first')
+        self.csrf_token = secrets.token_hex(16)
+        self.cookies = {user.pk: f'{session_cookie(user)}; {settings.CSRF_COOKIE_NAME}={self.csrf_token}'
+                        for user in self.users + [self.admin]}
+
+        report = {
+            'started': datetime.now(timezone.utc).isoformat(),
+            'url': options['url'],
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count()
+            },
+            'dataset': {
+                'users': User.objects.filter(username__startswith=user_prefix).count(),
+                'files': File.objects.filter(user__username__startswith=user_prefix).count()
+            },
+            'options': {key: options[key] for key in ('requests', 'large_requests', 'warmup', 'concurrency',
+                                                      'small_size', 'large_size', 'seed')},
+            'scenarios': {}
+        }
+        for scenario in options['scenario'] or SCENARIOS:
+            report['scenarios'][scenario] = self.run_scenario(scenario)
+        report['client_peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Done, report written to {options["output"]}'))
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                regressions = self.compare(json.load(f), report, options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+
+    def run_scenario(self, scenario):
+        requests = getattr(self, f'{scenario}_requests')()
+        total = self.options['large_requests'] if scenario in LARGE_SCENARIOS else self.options['requests']
+        if self.options['warmup']:
+            self.run_requests(requests, self.options['warmup'])
+
+        pids = [pid for server_pid in self.options['server_pid'] for pid in process_tree(server_pid)]
+        reset_peak_rss(pids)
+        results, elapsed = self.run_requests(requests, total)
+        # Workers may have been started or replaced while the scenario ran.
+        peaks = peak_rss([pid for server_pid in self.options['server_pid'] for pid in process_tree(server_pid)])
+        self.cleanup(scenario)
+
+        done = [result for result in results if result.get('ok')]
+        errors = {}
+        for result in results:
+            if not result.get('ok'):
+                key = str(result.get('error') or result['status'])
+                errors[key] = errors.get(key, 0) + 1
+        latencies = sorted(result['latency'] * 1000 for result in done)
+        transferred = sum(result['bytes'] for result in done)
+        summary = {
+            'requests': len(results),
+            'completed': len(done),
+            'failed': len(results) - len(done),
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'throughput_rps': round(len(done) / elapsed, 2) if elapsed else None,
+            'throughput_mib_s': round(transferred / elapsed / 2 ** 20, 2) if elapsed else None,
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50), 2),
+                'p90': round(percentile(latencies, 90), 2),
+                'p99': round(percentile(latencies, 99), 2),
+                'mean': round(statistics.fmean(latencies), 2),
+                'max': round(latencies[-1], 2)
+            } if latencies else None,
+            'server_peak_rss_bytes': sum(peaks.values()) if peaks else None,
+            'server_max_process_rss_bytes': max(peaks.values()) if peaks else None
+        }
+        self.stderr.write(f'{scenario:<13} {summary["completed"]:>6} ok {summary["failed"]:>5} failed  '
+                          f'{summary["throughput_rps"] or 0:>9.1f} req/s  '
+                          f'p50 {(summary["latency_ms"] or {}).get("p50", 0):>9.1f} ms  '
+                          f'p99 {(summary["latency_ms"] or {}).get("p99", 0):>9.1f} ms')
+        return summary
+
+    def run_requests(self, requests, total):
+        """Send total requests, cycling through requests, from --concurrency threads; returns results and wall time."""
+        counter = itertools.count()
+        results = []
+
+        def client():
+            conn = None
+            while (index := next(counter)) < total:
+                if conn is None:
+                    conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80,
+                                                      timeout=self.options['timeout'])
+                result = self.send(conn, requests[index % len(requests)])
+                results.append(result)
+                if 'error' in result or result.get('close'):
+                    conn.close()
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+        threads = [threading.Thread(target=client) for _ in range(self.options['concurrency'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.perf_counter() - started
+
+    @staticmethod
+    def send(conn, request):
+        headers = dict(request.headers)
+        body = None
+        sent = 0
+        if request.body:
+            body, sent, body_headers = request.body()
+            headers.update(body_headers, **{'Content-Length': str(sent)})
+        started = time.perf_counter()
+        try:
+            conn.request(request.method, request.path, body=body, headers=headers)
+            response = conn.getresponse()
+            received = 0
+            while data := response.read(256 * 2 ** 10):
+                received += len(data)
+        except (OSError, http.client.HTTPException) as e:
+            return {'error': type(e).__name__}
+        return {'ok': response.status in request.expected, 'status': response.status,
+                'latency': time.perf_counter() - started, 'bytes': sent + received, 'close': response.will_close}
+
+    def cookie(self, user):
+        return {'Cookie': self.cookies[user.pk], 'X-CSRFToken': self.csrf_token}
+
+    def login_requests(self):
+        def body(user):
+            data = json.dumps({'username': user.username, 'password': self.options['password']}).encode()
+            return lambda: ([data], len(data), {'Content-Type': 'application/json'})
+
+        # LoginView answers a successful login with a redirect home.
+        return [Request('POST', '/login/', {'Cookie': f'{settings.CSRF_COOKIE_NAME}={self.csrf_token}',
+                                            'X-CSRFToken': self.csrf_token}, body(user), expected=(302,))
+                for user in self.users]
+
+    def upload_requests(self, size):
+        counter = itertools.count()
+        chunk = os.urandom(min(size, 256 * 2 ** 10))
+
+        def body():
+            boundary = secrets.token_hex(16)
+            name = f'bench-suite-{self.run_id}-{next(counter)}.bin'
+            head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n').encode('latin-1')
+            tail = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+            # A unique prefix keeps every upload from being deduplicated into the same blob.
+            unique = os.urandom(min(size, 16))
+
+            def chunks():
+                yield head + unique
+                sent = len(unique)
+                while sent < size:
+                    data = chunk[:size - sent]
+                    yield data
+                    sent += len(data)
+                yield tail
+            return (chunks(), len(head) + size + len(tail),
+                    {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+        return [Request('POST', '/files/upload/', self.cookie(user), body) for user in self.users]
+
+    def upload_small_requests(self):
+        return self.upload_requests(parse_size(self.options['small_size']))
+
+    def upload_large_requests(self):
+        return self.upload_requests(parse_size(self.options['large_size']))
+
+    def sample_files(self):
+        files = list(File.objects.filter(user__in=self.users, size__lte=parse_size(self.options['large_size']))
+                     .order_by('id').values_list('id', 'user_id', 'share_token')[:DOWNLOAD_SAMPLE * 10])
+        if not files:
+            raise CommandError('The dataset users have no files to download')
+        return self.rng.sample(files, min(len(files), DOWNLOAD_SAMPLE))
+
+    def download_requests(self):
+        users = {user.pk: user for user in self.users}
+        return [Request('GET', f'/files/{file_id}/download/', self.cookie(users[user_id]))
+                for file_id, user_id, _ in self.sample_files()]
+
+    def share_requests(self):
+        return [Request('GET', f'/files/{file_id}/download/{token}/')
+                for file_id, _, token in self.sample_files() if token]
+
+    def list_requests(self):
+        requests = []
+        for user in self.users:
+            for field in FILE_LIST_SORT_FIELDS:
+                for sort in (field, f'-{field}'):
+                    params = {'sort': sort, 'limit': 50}
+                    if self.rng.random() < 0.25:
+                        params['name'] = self.rng.choice(WORDS)
+                    requests.append(Request('GET', f'/files/get/?{urlencode(params)}', self.cookie(user)))
+        self.rng.shuffle(requests)
+        return requests
+
+    def admin_list_requests(self):
+        month_ago = (datetime.now(timezone.utc) - timedelta(days=30)).strftime('%d.%m.%Y')
+        filters = [
+            {},
+            {'filter': 'original_name', 'filter_value': self.rng.choice(WORDS)},
+            {'filter': 'name', 'filter_value': self.rng.choice(WORDS)},
+            {'filter': 'username', 'filter_value': self.users[0].username},
+            {'filter': 'user_id', 'filter_value': self.users[-1].pk},
+            {'filter': 'size', 'filter_value': 64 * 2 ** 10},
+            {'filter': 'upload_date', 'filter_value': month_ago},
+            {'original_name': self.rng.choice(WORDS), 'upload_date': month_ago}
+        ]
+        return [Request('GET', f'/admin/files/get/?{urlencode({"sort": sort, "limit": 50, **params})}',
+                        self.cookie(self.admin))
+                for params in filters
+                for field in ADMIN_FILE_SORT_FIELDS
+                for sort in (field, f'-{field}')]
+
+    def cleanup(self, scenario):
+        if scenario.startswith('upload'):
+            File.objects.delete_files(File.objects.filter(
+                user__in=self.users, original_name__startswith=f'bench-suite-{self.run_id}-'
+            ).values_list('id', flat=True))
+
+    @staticmethod
+    def compare(baseline, report, tolerance):
+        """Scenarios whose throughput dropped or p99 latency grew by more than tolerance against baseline."""
+        regressions = []
+        for scenario, summary in report['scenarios'].items():
+            before = baseline.get('scenarios', {}).get(scenario)
+            if not before or not before.get('latency_ms') or not summary.get('latency_ms'):
+                continue
+            if summary['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+                regressions.append(f'{scenario}: throughput {before["throughput_rps"]} -> '
+                                   f'{summary["throughput_rps"]} req/s')
+            if summary['latency_ms']['p99'] > before['latency_ms']['p99'] * (1 + tolerance):
+                regressions.append(f'{scenario}: p99 {before["latency_ms"]["p99"]} -> '
+                                   f'{summary["latency_ms"]["p99"]} ms')
+        return regressions
@@ -0,0 +1,230 @@
+import asyncio
+import os
+import secrets
+import statistics
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import File, blob_temp_directory
+from ...uploads import hash_file
+from ....accounts.models import User
+
+BENCH_USERNAME = 'bench-transfers'
+
+SCENARIOS = ('download', 'share', 'upload')
+
+
+def parse_size(value):
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    value = value.strip().upper().removesuffix('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def session_cookie(user):
+    """Cookie of a new session logged in as user, created in the database the server uses."""
+    session = SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+class Command(BaseCommand):
+    help = ('Load test uploads and downloads against a running server with many slow concurrent clients. '
+            'Run it once against the WSGI deployment (gunicorn storage_server.wsgi) and once against the '
+            'ASGI one (FILES_ASYNC_VIEWS=1 uvicorn storage_server.asgi:application) with the same options '
+            'to compare them. The command has to use the same database as the server, as it logs the '
+            f'benchmark user "{BENCH_USERNAME}" in by creating its session directly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Server base URL')
+        parser.add_argument('--scenario', choices=SCENARIOS, default='download')
+        parser.add_argument('--concurrency', type=int, default=500, help='Simultaneous clients (default: 500)')
+        parser.add_argument('--requests', type=int, default=0,
+                            help='Total transfers (default: one per client)')
+        parser.add_argument('--size', default='4M', help='Bytes per transfer, K/M/G suffixes allowed (default: 4M)')
+        parser.add_argument('--rate', default='512K',
+                            help='Bytes per second each client sends or reads, 0 for unlimited (default: 512K)')
+        parser.add_argument('--timeout', type=float, default=600, help='Seconds before a transfer is abandoned')
+        parser.add_argument('--cleanup', action='store_true', help=f'Delete the {BENCH_USERNAME} user and its files')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            user = User.objects.filter(username=BENCH_USERNAME).first()
+            if user:
+                File.objects.delete_files(user.files.values_list('id', flat=True))
+                user.delete()
+            self.stdout.write(self.style.SUCCESS('Removed benchmark user and files'))
+            return
+
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError('Only http:// URLs are supported')
+        size = parse_size(options['size'])
+        rate = parse_size(options['rate'])
+        total = options['requests'] or options['concurrency']
+
+        user, _ = User.objects.get_or_create(username=BENCH_USERNAME, defaults={'email': f'{BENCH_USERNAME}@localhost'})
+        self.cookie = session_cookie(user)
+        if options['scenario'] == 'upload':
+            self.csrf_token = secrets.token_hex(16)
+            self.cookie += f'; {settings.CSRF_COOKIE_NAME}={self.csrf_token}'
+            run_id = secrets.token_hex(4)
+            targets = [f'bench-{run_id}-{i}.bin' for i in range(total)]
+        else:
+            file = self.bench_file(user, size)
+            path = (f'/files/{file.id}/download/' if options['scenario'] == 'download'
+                    else f'/files/{file.id}/download/{file.share_token}/')
+            targets = [path] * total
+
+        self.stdout.write(f'{options["scenario"]}: {total} transfers of {size} bytes, {options["concurrency"]} '
+                          f'concurrent clients at {rate or "unlimited"} B/s each against {options["url"]}')
+        results, elapsed, peak = asyncio.run(self.run(url, options['scenario'], targets, size, rate,
+                                                      options['concurrency'], options['timeout']))
+        self.report(results, elapsed, peak, size)
+
+        if options['scenario'] == 'upload':
+            File.objects.delete_files(user.files.filter(original_name__in=targets).values_list('id', flat=True))
+
+    def bench_file(self, user, size):
+        name = f'bench-{size}.bin'
+        file = File.objects.filter(user=user, original_name=name).first()
+        if file:
+            return file
+        self.stdout.write(f'Creating {name}...')
+        os.makedirs(blob_temp_directory(), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=blob_temp_directory(), suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            for start in range(0, size, 2 ** 20):
+                f.write(os.urandom(min(2 ** 20, size - start)))
+        return File.objects.create_from_temp(user, name, '', temp_path, hash_file(temp_path), size)
+
+    async def run(self, url, scenario, targets, size, rate, concurrency, timeout):
+        queue = asyncio.Queue()
+        for target in targets:
+            queue.put_nowait(target)
+        results = []
+        state = {'active': 0, 'peak': 0}
+
+        async def client():
+            while not queue.empty():
+                target = queue.get_nowait()
+                try:
+                    results.append(await asyncio.wait_for(
+                        self.transfer(url, scenario, target, size, rate, state), timeout))
+                except (OSError, asyncio.TimeoutError, ValueError) as e:
+                    results.append({'error': type(e).__name__})
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return results, time.perf_counter() - started, state['peak']
+
+    async def transfer(self, url, scenario, target, size, rate, state):
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80, limit=2 ** 20)
+        try:
+            if scenario == 'upload':
+                await self.send_upload(writer, url, target, size, rate)
+            else:
+                writer.write((f'GET {target} HTTP/1.1\r\nHost: {url.netloc}\r\nCookie: {self.cookie}\r\n'
+                              'Connection: close\r\n\r\n').encode('latin-1'))
+                await writer.drain()
+
+            status, headers = await self.read_head(reader)
+            first_byte = time.perf_counter() - started
+            state['active'] += 1
+            state['peak'] = max(state['peak'], state['active'])
+            try:
+                received = await self.read_body(reader, int(headers.get('content-length', 0)), rate)
+            finally:
+                state['active'] -= 1
+        finally:
+            writer.close()
+        return {'status': status, 'first_byte': first_byte, 'total': time.perf_counter() - started,
+                'bytes': size if scenario == 'upload' else received}
+
+    async def send_upload(self, writer, url, name, size, rate):
+        boundary = secrets.token_hex(16)
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').encode('latin-1')
+        tail = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+        writer.write((f'POST /files/upload/ HTTP/1.1\r\nHost: {url.netloc}\r\nCookie: {self.cookie}\r\n'
+                      f'X-CSRFToken: {self.csrf_token}\r\n'
+                      f'Content-Type: multipart/form-data; boundary={boundary}\r\n'
+                      f'Content-Length: {len(head) + size + len(tail)}\r\nConnection: close\r\n\r\n')
+                     .encode('latin-1') + head)
+        chunk = os.urandom(min(size, 64 * 2 ** 10))
+        sent = 0
+        started = time.perf_counter()
+        while sent < size:
+            data = chunk[:size - sent]
+            writer.write(data)
+            await writer.drain()
+            sent += len(data)
+            await self.throttle(started, sent, rate)
+        writer.write(tail)
+        await writer.drain()
+
+    @staticmethod
+    async def read_head(reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        return status, headers
+
+    async def read_body(self, reader, length, rate):
+        received = 0
+        started = time.perf_counter()
+        while received < length:
+            data = await reader.read(min(64 * 2 ** 10, length - received))
+            if not data:
+                break
+            received += len(data)
+            await self.throttle(started, received, rate)
+        return received
+
+    @staticmethod
+    async def throttle(started, done, rate):
+        if rate:
+            delay = done / rate - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    def report(self, results, elapsed, peak, size):
+        done = [result for result in results if 'status' in result and result['status'] < 400]
+        failed = len(results) - len(done)
+        transferred = sum(result['bytes'] for result in done)
+        self.stdout.write(f'completed: {len(done)}  failed: {failed}  wall time: {elapsed:.2f} s')
+        self.stdout.write(f'throughput: {len(done) / elapsed:.2f} transfers/s, '
+                          f'{transferred / elapsed / 2 ** 20:.2f} MiB/s')
+        self.stdout.write(f'peak transfers served at once: {peak}')
+        if done:
+            for key, label in (('first_byte', 'time to first byte'), ('total', 'transfer time')):
+                values = sorted(result[key] * 1000 for result in done)
+                self.stdout.write(f'{label:<20} p50 {self.percentile(values, 50):>10.1f} ms  '
+                                  f'p99 {self.percentile(values, 99):>10.1f} ms  max {values[-1]:>10.1f} ms')
+        errors = {}
+        for result in results:
+            key = result.get('error') or (result['status'] if result['status'] >= 400 else None)
+            if key:
+                errors[key] = errors.get(key, 0) + 1
+        if errors:
+            self.stdout.write(self.style.WARNING(f'errors: {errors}'))
+
+    @staticmethod
+    def percentile(values, percent):
+        return statistics.quantiles(values, n=100, method='inclusive')[percent - 1] if len(values) > 1 else values[0]
@@ -0,0 +1,192 @@
+import hashlib
+import math
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from .bench_file_search import EXTENSIONS, WORDS
+from .bench_transfers import parse_size
+from ...models import Blob, File, blob_temp_directory, new_share_token
+from ...workers import delete_stored_in_background, remove_files
+from ....accounts.models import User
+
+DEFAULT_PREFIX = 'bench'
+DEFAULT_PASSWORD = 'bench-password'
+
+
+def dataset_usernames(prefix):
+    """Usernames of the regular users and of the admin user generated with the given prefix."""
+    return f'{prefix}-user-', f'{prefix}-admin'
+
+
+class Command(BaseCommand):
+    help = ('Generate a synthetic dataset for the benchmarks: --users users named <prefix>-user-<n>, an '
+            '<prefix>-admin admin, and --files files spread over the users so that a few of them own most '
+            'files. File sizes follow a log-normal distribution around --median-size, as real uploads do, '
+            'and a --duplicates fraction of files repeat earlier contents, so the blob store deduplicates '
+            'them. Contents are random bytes written through the blob store, so they can be downloaded; '
+            'previews are left to the generate_previews command. The same options and --seed generate the '
+            'same users, names, sizes and contents, and running the command again only adds what is missing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Regular users to generate (default: 100)')
+        parser.add_argument('--files', type=int, default=10_000, help='Files to generate in total (default: 10000)')
+        parser.add_argument('--median-size', default='64K',
+                            help='Median file size, K/M/G suffixes allowed (default: 64K)')
+        parser.add_argument('--size-sigma', type=float, default=2.0,
+                            help='Standard deviation of the natural log of file sizes (default: 2.0)')
+        parser.add_argument('--max-size', default='256M', help='Largest file generated (default: 256M)')
+        parser.add_argument('--duplicates', type=float, default=0.1,
+                            help='Fraction of files with the same content as an earlier file (default: 0.1)')
+        parser.add_argument('--days', type=int, default=365,
+                            help='Upload dates are spread over this many past days (default: 365)')
+        parser.add_argument('--prefix', default=DEFAULT_PREFIX, help=f'Username prefix (default: {DEFAULT_PREFIX})')
+        parser.add_argument('--password', default=DEFAULT_PASSWORD,
+                            help=f'Password of every generated user (default: {DEFAULT_PASSWORD})')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Files created per transaction (default: 500)')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the generated users and their files')
+
+    def handle(self, *args, **options):
+        user_prefix, admin_username = dataset_usernames(options['prefix'])
+        if options['cleanup']:
+            users = User.objects.filter(username__startswith=user_prefix) | User.objects.filter(username=admin_username)
+            File.objects.delete_files(File.objects.filter(user__in=users).values_list('id', flat=True))
+            users.delete()
+            self.stdout.write(self.style.SUCCESS('Removed generated users and files'))
+            return
+
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.median_size = parse_size(options['median_size'])
+        self.max_size = parse_size(options['max_size'])
+
+        users = self.create_users(user_prefix, admin_username)
+        # Zipf-like weights: the n-th user owns about 1/n as many files as the first.
+        weights = [1 / (n + 1) for n in range(len(users))]
+        existing = File.objects.filter(user__in=users).count()
+
+        created = 0
+        total_bytes = 0
+        contents = []
+        for start in range(0, options['files'], options['batch_size']):
+            specs = [self.file_spec(i, users, weights, contents)
+                     for i in range(start, min(start + options['batch_size'], options['files']))]
+            if start + len(specs) <= existing:
+                # Generated by an earlier run; the specs are still drawn to keep the random sequence the same.
+                continue
+            count, size = self.create_files(specs)
+            created += count
+            total_bytes += size
+            self.stdout.write(f'  {start + len(specs)}/{options["files"]} files')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Done, {len(users)} users and {admin_username}, created {created} files of {total_bytes} bytes'))
+
+    def create_users(self, user_prefix, admin_username):
+        # Hashing is slow by design, so every user shares one hash of the same password.
+        password = make_password(self.options['password'])
+        usernames = [f'{user_prefix}{n:06d}' for n in range(self.options['users'])]
+        found = set(User.objects.filter(username__in=usernames + [admin_username]).values_list('username', flat=True))
+        User.objects.bulk_create([
+            User(username=username, email=f'{username}@localhost', full_name=username, password=password,
+                 is_admin=username == admin_username)
+            for username in usernames + [admin_username] if username not in found
+        ])
+        users = {user.username: user for user in User.objects.filter(username__in=usernames)}
+        return [users[username] for username in usernames]
+
+    def file_size(self):
+        size = int(self.rng.lognormvariate(math.log(self.median_size), self.options['size_sigma']))
+        return max(1, min(size, self.max_size))
+
+    def file_spec(self, i, users, weights, contents):
+        """Owner, name, upload date and content seed of the i-th file, reusing an earlier content for duplicates."""
+        user = self.rng.choices(users, weights)[0]
+        name = f'{self.rng.choice(WORDS)}_{self.rng.choice(WORDS)}_{i}.{self.rng.choice(EXTENSIONS)}'
+        uploaded = datetime.now(timezone.utc) - timedelta(seconds=self.rng.uniform(0, self.options['days'] * 86400))
+        if contents and self.rng.random() < self.options['duplicates']:
+            content = self.rng.choice(contents)
+        else:
+            content = (self.rng.getrandbits(64), self.file_size())
+            contents.append(content)
+        return user, name, uploaded, content
+
+    def write_content(self, seed, size):
+        """Write size random bytes from seed to a temp file for the blob store; returns its path and digest."""
+        os.makedirs(blob_temp_directory(), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=blob_temp_directory(), prefix='.dataset-', suffix='.part')
+        rng = random.Random(seed)
+        sha256 = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as f:
+            for start in range(0, size, 2 ** 20):
+                data = rng.randbytes(min(2 ** 20, size - start))
+                sha256.update(data)
+                f.write(data)
+        return temp_path, sha256.hexdigest()
+
+    def create_files(self, specs):
+        """Create the files of a batch not generated yet; returns how many were created and their total size."""
+        taken = set(File.objects.filter(user__in={user for user, _, _, _ in specs},
+                                        original_name__in=[name for _, name, _, _ in specs])
+                    .values_list('user_id', 'original_name'))
+        specs = [spec for spec in specs if (spec[0].pk, spec[1]) not in taken]
+
+        # Contents are written and stored before the transaction, so uploads to remote storage hold no locks.
+        staged = {}
+        try:
+            for _, _, _, content in specs:
+                if content in staged:
+                    continue
+                seed, size = content
+                temp_path, sha256 = self.write_content(seed, size)
+                try:
+                    staged[content] = Blob.objects.stage(temp_path, sha256), sha256
+                except BaseException:
+                    remove_files([temp_path])
+                    raise
+            return self.create_staged_files(specs, staged)
+        except BaseException:
+            delete_stored_in_background([staged_name for staged_name, _ in staged.values()])
+            raise
+
+    def create_staged_files(self, specs, staged):
+        """Create the files of a batch in one transaction, their contents staged as staged[content]."""
+        with transaction.atomic():
+            blobs = {}
+            references = {}
+            for _, _, _, content in specs:
+                if content in blobs:
+                    references[content] += 1
+                    continue
+                staged_name, sha256 = staged[content]
+                blobs[content] = Blob.objects.store(staged_name, sha256, content[1])
+                references[content] = 0
+            for content, count in references.items():
+                if count:
+                    Blob.objects.filter(pk=blobs[content].pk).update(ref_count=F('ref_count') + count)
+
+            files = File.objects.bulk_create([
+                File(user=user, original_name=name, name=name, size=blobs[content].size, comment='',
+                     sha256=blobs[content].sha256, blob=blobs[content], path=blobs[content].path,
+                     share_token=new_share_token())
+                for user, name, _, content in specs
+            ])
+            # upload_date is set on insert; spread it over the past afterwards.
+            for file, (_, _, uploaded, _) in zip(files, specs):
+                file.upload_date = uploaded
+            File.objects.bulk_update(files, ['upload_date'])
+
+            usage = {}
+            for file in files:
+                size, count = usage.get(file.user_id, (0, 0))
+                usage[file.user_id] = (size + file.size, count + 1)
+            for user_id, (size, count) in usage.items():
+                User.objects.add_usage(user_id, size, count)
+        return len(files), sum(file.size for file in files)
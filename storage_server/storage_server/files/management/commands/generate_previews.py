@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import Blob, File
+from ...previews import PREVIEW_NONE
+
+
+class Command(BaseCommand):
+    help = ('Render previews for stored contents that have none yet, such as files uploaded before previews '
+            'existed or whose background job was dropped because the preview queue was full.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Blobs loaded per query (default: 100)')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit disk and CPU load')
+        parser.add_argument('--retry-unsupported', action='store_true',
+                            help='Also retry contents that got no preview before, e.g. after installing Pillow')
+
+    def handle(self, *args, **options):
+        states = [''] + ([PREVIEW_NONE] if options['retry_unsupported'] else [])
+        last_id = 0
+        counts = {}
+        while True:
+            blobs = list(Blob.objects.filter(id__gt=last_id, preview__in=states).order_by('id')[:options['batch_size']])
+            if not blobs:
+                break
+            last_id = blobs[-1].id
+            names = dict(
+                File.objects.filter(blob__in=blobs).order_by('blob_id', 'id').values_list('blob_id', 'original_name')
+            )
+            for blob in blobs:
+                if blob.id not in names:
+                    continue
+                kind = Blob.objects.generate_preview(blob, names[blob.id])
+                counts[kind] = counts.get(kind, 0) + 1
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        summary = ', '.join(f'{count} {kind}' for kind, count in sorted(counts.items())) or 'nothing to do'
+        self.stdout.write(self.style.SUCCESS(f'Done, rendered previews: {summary}'))
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import F, Func, Value
+from django.db.models.functions import Length
+
+from ...models import File
+from ...storage import blob_temp_directory, get_storage
+
+
+class Command(BaseCommand):
+    help = ('Move file contents still stored in the legacy File.data column to disk and clear the column. '
+            'Rows are moved one at a time, each in its own short transaction, and their contents are read '
+            'from the database in chunks, so memory stays bounded however large the stored contents are. '
+            'Can be interrupted and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of row ids looked up per query (default: 50)')
+        parser.add_argument('--chunk-size', type=int, default=8 * 2 ** 20,
+                            help='Bytes of a row read from the database at a time (default: 8 MiB)')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit database load')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the rows that still have contents in the database')
+
+    def handle(self, *args, **options):
+        pending = File.objects.filter(data__isnull=False)
+
+        if options['dry_run']:
+            self.stdout.write(f'{pending.count()} files still have contents in the database')
+            return
+
+        self.chunk_size = options['chunk_size']
+        moved = 0
+        last_id = 0
+        while True:
+            # Only ids here: the contents are never loaded for more than one row, and then only a chunk at a time.
+            ids = list(pending.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)
+                       [:options['batch_size']])
+            if not ids:
+                break
+
+            for file_id in ids:
+                with transaction.atomic():
+                    file = (pending.filter(id=file_id).select_for_update(skip_locked=True)
+                            .only('id', 'path', 'sha256').annotate(data_size=Length('data')).first())
+                    if file is None:
+                        continue
+                    sha256 = self.move_to_disk(file)
+                    File.objects.filter(id=file_id).update(data=None, sha256=sha256)
+                moved += 1
+
+            last_id = ids[-1]
+            self.stdout.write(f'Moved {moved} files (last id {last_id})')
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write(self.style.SUCCESS(f'Done, moved {moved} files'))
+
+    def read_chunks(self, file):
+        """The contents of file's data column, chunk_size bytes per query."""
+        for start in range(0, file.data_size, self.chunk_size):
+            # SUBSTR positions start at 1.
+            chunk = Func(F('data'), Value(start + 1), Value(self.chunk_size), function='SUBSTR',
+                         output_field=models.BinaryField())
+            yield bytes(File.objects.filter(id=file.id).annotate(chunk=chunk).values_list('chunk', flat=True)[0])
+
+    def move_to_disk(self, file):
+        digest = hashlib.sha256()
+        storage = get_storage()
+
+        if storage.exists(file.path) and storage.size(file.path) == file.data_size:
+            for chunk in self.read_chunks(file):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+        os.makedirs(blob_temp_directory(), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=blob_temp_directory(), prefix='.migrate-', suffix='.part')
+        try:
+            with open(fd, 'wb') as f:
+                for chunk in self.read_chunks(file):
+                    digest.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            storage.save(temp_path, file.path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return digest.hexdigest()
@@ -0,0 +1,60 @@
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from ...models import UploadSession, blob_temp_directory
+from ...workers import remove_files
+
+
+class Command(BaseCommand):
+    help = ('Delete expired resumable upload sessions together with their partially received files, and the '
+            'partially received files left behind by sessions deleted along with their user')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=float, default=60 * 60,
+                            help='Seconds since last modification before a session file without a session is '
+                                 'removed, so sessions that are still being created are left alone (default: 3600)')
+
+    def handle(self, *args, **options):
+        expired = UploadSession.objects.filter(expires_date__lt=datetime.now(timezone.utc))
+        purged = 0
+        for session in expired.iterator():
+            session.delete()
+            purged += 1
+        orphans = self.purge_orphans(options['min_age'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Purged {purged} expired upload sessions and {orphans} files of deleted sessions'))
+
+    def purge_orphans(self, min_age):
+        """Remove session files old enough and with no session left; returns how many were removed."""
+        cutoff = time.time() - min_age
+        sessions = {}
+        try:
+            entries = os.scandir(blob_temp_directory())
+        except FileNotFoundError:
+            return 0
+        with entries:
+            for entry in entries:
+                session_id = entry.name.removeprefix('session-').removesuffix('.part')
+                if (entry.name.startswith('session-') and self.is_uuid(session_id)
+                        and entry.is_file(follow_symlinks=False)
+                        and entry.stat(follow_symlinks=False).st_mtime < cutoff):
+                    sessions[entry.path] = session_id
+        if not sessions:
+            return 0
+        found = {str(session_id) for session_id in
+                 UploadSession.objects.filter(id__in=sessions.values()).values_list('id', flat=True)}
+        orphans = [path for path, session_id in sessions.items() if session_id not in found]
+        remove_files(orphans)
+        return len(orphans)
+
+    @staticmethod
+    def is_uuid(value):
+        try:
+            uuid.UUID(value)
+        except ValueError:
+            return False
+        return True
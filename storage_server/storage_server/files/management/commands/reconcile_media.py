@@ -0,0 +1,230 @@
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from ...models import BLOBS_DIRECTORY, Blob, File, UploadSession, blob_temp_directory
+from ...previews import PREVIEW_CONTENT_TYPES, PREVIEW_IMAGE, PREVIEW_TEXT, PREVIEWS_DIRECTORY
+from ...storage import get_storage
+
+PREVIEW_EXTENSIONS = {'.jpg': PREVIEW_IMAGE, '.txt': PREVIEW_TEXT}
+
+
+class Throttle:
+    """Sleeps in tick() as needed to keep to rate checks per second, 0 for no limit."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.done = 0
+
+    def tick(self, count=1):
+        self.done += count
+        if self.rate:
+            delay = self.done / self.rate - (time.monotonic() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+
+
+class Command(BaseCommand):
+    help = ('Find drift between MEDIA_ROOT and the database in both directions: files on disk that no blob, '
+            'legacy file, preview or upload session refers to, and rows whose file is missing from disk. '
+            'Only reports by default. MEDIA_ROOT is walked with os.scandir and rows are streamed with '
+            'iterator(), both checked in batches, so memory stays bounded however many files there are. '
+            'Run it from cron, or keep it running with --every.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Paths or rows looked up per query (default: 1000)')
+        parser.add_argument('--rate', type=float, default=1000,
+                            help='Files and rows checked per second at most, 0 for no limit (default: 1000)')
+        parser.add_argument('--min-age', type=float, default=24 * 60 * 60,
+                            help='Seconds since last modification before a file on disk is checked, so '
+                                 'uploads that are still being committed are left alone (default: 86400)')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Remove files on disk that nothing in the database refers to')
+        parser.add_argument('--delete-missing', action='store_true',
+                            help='Delete files whose content is missing from disk, subtracting them from their '
+                                 "owners' usage, and forget missing previews so generate_previews renders "
+                                 'them again')
+        parser.add_argument('--every', type=float, default=0,
+                            help='Run again every this many seconds instead of once')
+
+    def handle(self, *args, **options):
+        if not get_storage().local:
+            raise CommandError('reconcile_media only supports the local storage backend')
+        while True:
+            self.reconcile(options)
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+
+    def reconcile(self, options):
+        self.options = options
+        self.throttle = Throttle(options['rate'])
+        self.orphans = 0
+        self.missing = 0
+        self.fixed = 0
+
+        batch = []
+        for entry in self.scan(settings.MEDIA_ROOT):
+            batch.append(entry)
+            if len(batch) >= options['batch_size']:
+                self.check_disk_batch(batch)
+                batch = []
+        self.check_disk_batch(batch)
+
+        self.check_blobs()
+        self.check_legacy_files()
+        self.check_previews()
+
+        summary = f'{self.orphans} orphaned files on disk, {self.missing} rows with missing files'
+        if options['delete_orphans'] or options['delete_missing']:
+            summary += f', {self.fixed} fixed'
+        self.stdout.write(self.style.SUCCESS(f'Done, found {summary}'))
+
+    def scan(self, path):
+        """Regular files under path old enough to be checked, as (relative path, stat) pairs."""
+        cutoff = time.time() - self.options['min_age']
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self.scan(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_mtime < cutoff:
+                        yield os.path.relpath(entry.path, settings.MEDIA_ROOT), stat
+
+    def check_disk_batch(self, batch):
+        """Report, and with --delete-orphans remove, the files in batch nothing refers to."""
+        if not batch:
+            return
+        self.throttle.tick(len(batch))
+        temp_directory = os.path.relpath(blob_temp_directory(), settings.MEDIA_ROOT) + os.sep
+        sessions, blobs, previews, legacy = {}, {}, {}, {}
+        for path, stat in batch:
+            name = os.path.basename(path)
+            if path.startswith(temp_directory):
+                session_id = name.removeprefix('session-').removesuffix('.part')
+                if name.startswith('session-') and self.is_uuid(session_id):
+                    sessions[path] = session_id
+                else:
+                    # Handler, compression and preview temp files only outlive a request when it crashed.
+                    self.orphaned(path, stat)
+            elif path.startswith(BLOBS_DIRECTORY + os.sep):
+                blobs[path] = path
+            elif path.startswith(PREVIEWS_DIRECTORY + os.sep):
+                key, extension = os.path.splitext(name)
+                if extension in PREVIEW_EXTENSIONS:
+                    previews[path] = (key, PREVIEW_EXTENSIONS[extension])
+                else:
+                    self.orphaned(path, stat)
+            else:
+                legacy[path] = path
+
+        known = set()
+        if sessions:
+            found = {str(session_id) for session_id in
+                     UploadSession.objects.filter(id__in=sessions.values()).values_list('id', flat=True)}
+            known.update(path for path, session_id in sessions.items() if session_id in found)
+        if blobs:
+            known.update(Blob.objects.filter(path__in=blobs).values_list('path', flat=True))
+        if previews:
+            # Keys start with the 64 character digest, which is unique among blobs.
+            found = {(os.path.basename(blob_path), preview) for blob_path, preview in
+                     Blob.objects.filter(sha256__in=[key[:64] for key, _ in previews.values()])
+                     .values_list('path', 'preview')}
+            known.update(path for path, key in previews.items() if key in found)
+        if legacy:
+            # Legacy rows store either the path relative to MEDIA_ROOT or the full path.
+            full_paths = {os.path.join(settings.MEDIA_ROOT, path): path for path in legacy}
+            for path in File.objects.filter(Q(path__in=legacy) | Q(path__in=full_paths)).values_list('path', flat=True):
+                known.add(full_paths.get(path, path))
+
+        checked = sessions.keys() | blobs.keys() | previews.keys() | legacy.keys()
+        for path, stat in batch:
+            if path in checked and path not in known:
+                self.orphaned(path, stat)
+
+    def orphaned(self, path, stat):
+        self.orphans += 1
+        self.stdout.write(f'Orphaned file on disk: {path} ({stat.st_size} bytes)')
+        if not self.options['delete_orphans']:
+            return
+        full_path = os.path.join(settings.MEDIA_ROOT, path)
+        try:
+            current = os.stat(full_path, follow_symlinks=False)
+        except FileNotFoundError:
+            return
+        # An upload storing the same content may have replaced the file since it was scanned.
+        if (current.st_ino, current.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+            return
+        try:
+            os.remove(full_path)
+        except FileNotFoundError:
+            return
+        self.fixed += 1
+
+    def check_blobs(self):
+        """Report, and with --delete-missing delete the files of, blobs whose file is missing."""
+        missing = []
+        for blob_id, path in Blob.objects.order_by().values_list('id', 'path').iterator(
+                chunk_size=self.options['batch_size']):
+            self.throttle.tick()
+            if not os.path.exists(os.path.join(settings.MEDIA_ROOT, path)):
+                self.missing += 1
+                self.stdout.write(f'Blob {blob_id} is missing its file {path}')
+                missing.append(blob_id)
+                if len(missing) >= self.options['batch_size']:
+                    self.delete_missing(File.objects.filter(blob_id__in=missing))
+                    missing = []
+        self.delete_missing(File.objects.filter(blob_id__in=missing))
+
+    def check_legacy_files(self):
+        """Report, and with --delete-missing delete, files stored outside the blob store whose file is missing."""
+        missing = []
+        for file_id, path in File.objects.filter(blob__isnull=True).order_by().values_list('id', 'path').iterator(
+                chunk_size=self.options['batch_size']):
+            self.throttle.tick()
+            if not os.path.exists(os.path.join(settings.MEDIA_ROOT, path)):
+                self.missing += 1
+                self.stdout.write(f'File {file_id} is missing its file {path}')
+                missing.append(file_id)
+                if len(missing) >= self.options['batch_size']:
+                    self.delete_missing(File.objects.filter(id__in=missing))
+                    missing = []
+        self.delete_missing(File.objects.filter(id__in=missing))
+
+    def delete_missing(self, files):
+        if self.options['delete_missing']:
+            self.fixed += len(File.objects.delete_files(files.values_list('id', flat=True)))
+
+    def check_previews(self):
+        """Report, and with --delete-missing forget, previews recorded on blobs whose file is missing."""
+        missing = []
+        for blob in Blob.objects.filter(preview__in=PREVIEW_CONTENT_TYPES).order_by().only(
+                'id', 'sha256', 'path', 'preview').iterator(chunk_size=self.options['batch_size']):
+            self.throttle.tick()
+            if not os.path.exists(os.path.join(settings.MEDIA_ROOT, blob.preview_name)):
+                self.missing += 1
+                self.stdout.write(f'Blob {blob.id} is missing its preview {blob.preview_name}')
+                missing.append(blob.id)
+                if len(missing) >= self.options['batch_size']:
+                    self.forget_previews(missing)
+                    missing = []
+        self.forget_previews(missing)
+
+    def forget_previews(self, blob_ids):
+        if blob_ids and self.options['delete_missing']:
+            self.fixed += Blob.objects.filter(id__in=blob_ids).update(preview='')
+
+    @staticmethod
+    def is_uuid(value):
+        try:
+            uuid.UUID(value)
+        except ValueError:
+            return False
+        return True
@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from ...models import File
+from ....accounts.models import User
+
+
+class Command(BaseCommand):
+    help = ("Recompute every user's used_bytes and file_count from their files and repair counters that "
+            'drifted. Users are processed in batches whose rows are locked while they are checked, so '
+            'uploads and deletions running at the same time are not lost.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Users checked per transaction (default: 500)')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit database load')
+        parser.add_argument('--dry-run', action='store_true', help='Only report drifted counters')
+
+    def handle(self, *args, **options):
+        last_id = 0
+        checked = 0
+        repaired = 0
+        while True:
+            with transaction.atomic():
+                users = list(
+                    User.objects.filter(id__gt=last_id).order_by('id')
+                    .select_for_update().only('id', 'used_bytes', 'file_count')[:options['batch_size']]
+                )
+                if not users:
+                    break
+                last_id = users[-1].id
+                totals = {
+                    row['user_id']: (row['size'] or 0, row['count'])
+                    for row in File.objects.filter(user_id__in=[user.id for user in users])
+                    .values('user_id').annotate(size=Sum('size'), count=Count('id')).order_by()
+                }
+                drifted = []
+                for user in users:
+                    used_bytes, file_count = totals.get(user.id, (0, 0))
+                    if (user.used_bytes, user.file_count) != (used_bytes, file_count):
+                        self.stdout.write(f'User {user.id}: {user.used_bytes} bytes in {user.file_count} files '
+                                          f'recorded, {used_bytes} bytes in {file_count} files stored')
+                        user.used_bytes = used_bytes
+                        user.file_count = file_count
+                        drifted.append(user)
+                if drifted and not options['dry_run']:
+                    User.objects.bulk_update(drifted, ['used_bytes', 'file_count'])
+            checked += len(users)
+            repaired += len(drifted)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        action = 'found' if options['dry_run'] else 'repaired'
+        self.stdout.write(self.style.SUCCESS(f'Done, checked {checked} users, {action} {repaired}'))
@@ -0,0 +1,201 @@
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...layout import sharded_path
+from ...models import BLOBS_DIRECTORY, Blob, File, blob_temp_directory
+from ...previews import PREVIEWS_DIRECTORY, preview_name
+from ...storage import get_storage
+from ...uploads import hash_file
+from ...workers import remove_files
+
+PREVIEW_KINDS = {'.jpg': 'image', '.txt': 'text'}
+
+
+class Command(BaseCommand):
+    help = ('Move stored files to the layout configured by FILES_SHARD_DEPTH and FILES_SHARD_WIDTH while the '
+            'server keeps running. Blobs are moved in batches, files stored outside the blob store '
+            '(MEDIA_ROOT/<user_id>/<name>) are moved into it, and previews are moved by their blob key. '
+            'Every file is hard linked at its new path before its rows are switched over, and the old path '
+            'is only removed --grace seconds later, so downloads that already looked it up keep working. '
+            'Can be interrupted and re-run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Files moved per transaction (default: 100)')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit disk and database load')
+        parser.add_argument('--grace', type=float, default=60.0,
+                            help='Seconds to keep old paths around after their rows moved (default: 60)')
+
+    def handle(self, *args, **options):
+        if not get_storage().local:
+            raise CommandError('relocate_media only supports the local storage backend')
+        self.options = options
+        # (time after which the paths may go, paths), oldest first.
+        self.retired = deque()
+
+        blobs = self.relocate_blobs()
+        legacy = self.relocate_legacy_files()
+        previews = self.relocate_previews()
+
+        if self.retired:
+            time.sleep(max(0.0, self.retired[-1][0] - time.monotonic()))
+            self.remove_retired()
+        self.stdout.write(self.style.SUCCESS(
+            f'Done, moved {blobs} blobs, {legacy} files into the blob store and {previews} previews'))
+
+    def retire(self, paths):
+        """Remove paths once the grace period is over, removing earlier ones that are due."""
+        if paths:
+            self.retired.append((time.monotonic() + self.options['grace'], paths))
+        self.remove_retired()
+
+    def remove_retired(self):
+        while self.retired and self.retired[0][0] <= time.monotonic():
+            remove_files(self.retired.popleft()[1])
+
+    def pause(self):
+        if self.options['sleep']:
+            time.sleep(self.options['sleep'])
+
+    @staticmethod
+    def link(source, target):
+        """Make target a hard link to source, or a copy where hard links are not supported."""
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            os.remove(target)
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+    def relocate_blobs(self):
+        moved = 0
+        last_id = 0
+        while True:
+            batch = list(Blob.objects.filter(id__gt=last_id).order_by('id').only('id', 'sha256', 'path')
+                         [:self.options['batch_size']])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            targets = {}
+            for blob in batch:
+                target = sharded_path(BLOBS_DIRECTORY, blob.key)
+                if blob.path != target and os.path.exists(blob.full_path):
+                    self.link(blob.full_path, os.path.join(settings.MEDIA_ROOT, target))
+                    targets[blob.id] = (blob.path, target)
+
+            old_paths = []
+            stale = []
+            with transaction.atomic():
+                current = dict(Blob.objects.filter(id__in=targets).select_for_update().values_list('id', 'path'))
+                for blob_id, (path, target) in targets.items():
+                    if current.get(blob_id) != path:
+                        # Released or moved since it was read; its new link is not needed.
+                        stale.append(os.path.join(settings.MEDIA_ROOT, target))
+                        continue
+                    Blob.objects.filter(id=blob_id).update(path=target)
+                    File.objects.filter(blob_id=blob_id).update(path=target)
+                    old_paths.append(os.path.join(settings.MEDIA_ROOT, path))
+            remove_files(stale)
+
+            moved += len(old_paths)
+            self.retire(old_paths)
+            if old_paths:
+                self.stdout.write(f'Moved {moved} blobs (last id {last_id})')
+            self.pause()
+        return moved
+
+    def relocate_legacy_files(self):
+        """Move files that have their own copy on disk into the blob store, deduplicating their contents."""
+        moved = 0
+        last_id = 0
+        pending = File.objects.filter(blob__isnull=True, data__isnull=True)
+        while True:
+            # Local storage stages files with a rename, so it is done inside the transaction.
+            staged = []
+            try:
+                with transaction.atomic():
+                    batch = list(
+                        pending.filter(id__gt=last_id).order_by('id').select_for_update(skip_locked=True)
+                        .only('id', 'path', 'size', 'sha256', 'blob')[:self.options['batch_size']]
+                    )
+                    if not batch:
+                        break
+                    last_id = batch[-1].id
+
+                    old_paths = []
+                    for file in batch:
+                        if not os.path.exists(file.full_path):
+                            continue
+                        os.makedirs(blob_temp_directory(), exist_ok=True)
+                        fd, temp_path = tempfile.mkstemp(dir=blob_temp_directory(), prefix='.relocate-',
+                                                         suffix='.part')
+                        os.close(fd)
+                        try:
+                            self.link(file.full_path, temp_path)
+                            sha256 = file.sha256 or hash_file(temp_path)
+                            staged.append(Blob.objects.stage(temp_path, sha256))
+                        except BaseException:
+                            remove_files([temp_path])
+                            raise
+                        blob = Blob.objects.store(staged[-1], sha256, file.size)
+                        old_paths.append(file.full_path)
+                        file.blob = blob
+                        file.path = blob.path
+                        file.sha256 = sha256
+                        file.save(update_fields=['blob', 'path', 'sha256'])
+            except BaseException:
+                get_storage().delete(staged)
+                raise
+
+            moved += len(old_paths)
+            self.retire(old_paths)
+            if old_paths:
+                self.stdout.write(f'Moved {moved} files into the blob store (last id {last_id})')
+            self.pause()
+        return moved
+
+    def relocate_previews(self):
+        """
+        Move previews by the blob key in their file names. They are derived data, so
+        they are renamed rather than linked: a preview requested mid-move is a 404
+        the client retries later, not a failed download.
+        """
+        moved = 0
+        root = os.path.join(settings.MEDIA_ROOT, PREVIEWS_DIRECTORY)
+        if not os.path.isdir(root):
+            return moved
+        for path in self.scan(root):
+            key, extension = os.path.splitext(os.path.basename(path))
+            if extension not in PREVIEW_KINDS:
+                continue
+            target = os.path.join(settings.MEDIA_ROOT, preview_name(key, PREVIEW_KINDS[extension]))
+            if path == target:
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            moved += 1
+            if moved % self.options['batch_size'] == 0:
+                self.stdout.write(f'Moved {moved} previews')
+                self.remove_retired()
+                self.pause()
+        return moved
+
+    def scan(self, path):
+        # Listed before yielding, as moving files into directories being scanned would list them again.
+        with os.scandir(path) as entries:
+            entries = [(entry.path, entry.is_dir(follow_symlinks=False)) for entry in entries]
+        for entry_path, is_dir in entries:
+            if is_dir:
+                yield from self.scan(entry_path)
+            else:
+                yield entry_path
@@ -1,34 +1,359 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Case, F, Value, When
 from ..accounts.models import User
-from hashlib import sha256
+from collections import Counter
+from functools import partial
+from .compression import open_decoded
+from .layout import sharded_path
+from .previews import PREVIEW_NONE, preview_name, render_preview
+from .storage import BLOBS_DIRECTORY, blob_temp_directory, get_storage
+from .workers import delete_stored_in_background, submit_preview
 import secrets
+import uuid
 import os
 from django.conf import settings
+from ..logger import logger
+
+
+# Files stored on their own, outside the blob store.
+FILES_DIRECTORY = 'files'
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def new_share_token():
+    return secrets.token_hex(32)
+
+
+def new_blob_key(sha256):
+    """
+    Storage key for a new Blob row: the digest of its content and a random
+    suffix. The files of a released blob are removed after its row is gone, so
+    a later blob with the same content must never be stored under the same name.
+    """
+    return f'{sha256}-{uuid.uuid4().hex[:16]}'
+
+
+class BlobManager(models.Manager):
+    def stage(self, temp_path, sha256):
+        """
+        Move temp_path into storage under a new key for the content with the
+        given digest and return its name, for store() to take a reference to.
+        Uploads to remote storage can take minutes, so this is done before the
+        transaction that stores the blob, with no rows locked.
+        """
+        name = sharded_path(BLOBS_DIRECTORY, new_blob_key(sha256))
+        get_storage().save(temp_path, name)
+        return name
+
+    def store(self, name, sha256, size, encoding=''):
+        """
+        Take a reference to the blob with the given content, whose file was
+        stored as name by stage(). The staged file becomes the blob's if the
+        content is new and is removed once the transaction commits otherwise.
+        encoding is the compression the file is stored with, if any.
+        Must be called inside a transaction, together with saving the File that
+        holds the reference; if the transaction rolls back, the caller removes
+        the staged file.
+        """
+        blob, created = self.select_for_update().get_or_create(
+            sha256=sha256,
+            defaults={
+                'size': size,
+                'path': name,
+                'encoding': encoding
+            }
+        )
+        if not created and get_storage().exists(blob.path):
+            transaction.on_commit(partial(delete_stored_in_background, [name]))
+        elif not created:
+            # The blob's file went missing, the staged file replaces it and the files sharing it follow.
+            logger.warning('File of blob %s is missing, replacing it with %s', blob.pk, name)
+            stale = [blob.path] + ([blob.preview_name] if blob.preview_name else [])
+            blob.path, blob.encoding, blob.preview = name, encoding, ''
+            blob.save(update_fields=['path', 'encoding', 'preview'])
+            File.objects.filter(blob=blob).update(path=name)
+            transaction.on_commit(partial(delete_stored_in_background, stale))
+        self.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+        blob.ref_count += 1
+        return blob
+
+    def release(self, counts):
+        """
+        Drop counts[blob_id] references from each blob. Blobs left without
+        references are deleted and their files removed from storage in the background once
+        the transaction commits. Must be called inside a transaction.
+        """
+        if not counts:
+            return
+        orphaned = []
+        kept = []
+        for blob in self.select_for_update().filter(pk__in=counts).order_by('pk'):
+            if blob.ref_count > counts[blob.pk]:
+                kept.append(blob.pk)
+            else:
+                orphaned.append(blob)
+        if kept:
+            self.filter(pk__in=kept).update(ref_count=F('ref_count') - Case(
+                *[When(pk=blob_id, then=Value(counts[blob_id])) for blob_id in kept],
+                output_field=models.PositiveIntegerField()
+            ))
+        if orphaned:
+            self.filter(pk__in=[blob.pk for blob in orphaned]).delete()
+            names = [blob.path for blob in orphaned]
+            names += [blob.preview_name for blob in orphaned if blob.preview_name]
+            transaction.on_commit(partial(delete_stored_in_background, names))
+
+    def generate_preview(self, blob, name):
+        """
+        Render the preview of blob, using name to tell what kind of file it is,
+        and record its kind. Failures are logged and recorded as no preview.
+        """
+        try:
+            kind = render_preview(blob.open, name, blob.key, blob.size)
+        except Exception:
+            logger.exception('Rendering the preview of blob %s failed', blob.pk)
+            kind = PREVIEW_NONE
+        self.filter(pk=blob.pk).update(preview=kind)
+        return kind
+
+    def generate_preview_job(self, blob_id, name):
+        """generate_preview for the preview thread pool, which has its own database connection."""
+        try:
+            blob = self.filter(pk=blob_id, preview='').first()
+            if blob:
+                self.generate_preview(blob, name)
+        finally:
+            connection.close()
+
+    def schedule_preview(self, blob_id, name):
+        if not submit_preview(self.generate_preview_job, blob_id, name):
+            logger.warning('Preview queue full, skipping preview of blob %s', blob_id)
+
+
+class Blob(models.Model):
+    """
+    File contents stored once per SHA-256 digest and shared by every File with
+    that content, under a key made of the digest and a suffix unique to the row.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    path = models.CharField(max_length=255)
+    ref_count = models.PositiveIntegerField(default=0)
+    # Compression the file is stored with ('gzip' or 'zstd'), '' when stored as is. size is always the original size.
+    encoding = models.CharField(max_length=10, blank=True, default='')
+    # Kind of the cached preview ('image' or 'text'), 'none' if there is none and '' until it is rendered.
+    preview = models.CharField(max_length=10, blank=True, default='')
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    objects = BlobManager()
+
+    @property
+    def full_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.path)
+
+    @property
+    def key(self):
+        """Name the blob's files are stored under, the bare digest for blobs stored before keys were per row."""
+        return os.path.basename(self.path)
+
+    @property
+    def preview_name(self):
+        if not self.preview or self.preview == PREVIEW_NONE:
+            return None
+        return preview_name(self.key, self.preview)
+
+    def open(self):
+        f = get_storage().open(self.path)
+        if self.encoding:
+            return open_decoded(f, self.encoding)
+        return f
+
+
+class FileManager(models.Manager):
+    def get_queryset(self):
+        # Contents live on disk; the legacy data column is only read by the migrate_file_data command.
+        return super().get_queryset().defer('data')
+
+    def create_from_temp(self, user, original_name, comment, temp_path, sha256, size, encoding=''):
+        """
+        Store the fully received temp_path in the blob store and create the File
+        referencing it, adding it to the user's usage. Raises QuotaExceeded if it
+        does not fit in the user's quota and IntegrityError if the user already
+        has a file with this name; temp_path is gone either way.
+        Must not be called inside a transaction, see BlobManager.stage().
+        """
+        name = Blob.objects.stage(temp_path, sha256)
+        try:
+            return self.create_from_staged(user, original_name, comment, name, sha256, size, encoding)
+        except BaseException:
+            delete_stored_in_background([name])
+            raise
+
+    def create_from_staged(self, user, original_name, comment, name, sha256, size, encoding=''):
+        """
+        create_from_temp for contents already stored as name by BlobManager.stage(),
+        for callers that need their own transaction around it. The caller removes
+        the staged file if the transaction rolls back.
+        """
+        with transaction.atomic():
+            # Taken first so the user row lock also orders concurrent uploads against reconcile_storage_usage.
+            if not User.objects.add_usage(user.pk, size, quota=user.quota):
+                raise QuotaExceeded('Storage quota exceeded')
+            blob = Blob.objects.store(name, sha256, size, encoding)
+            file = self.model(
+                user=user,
+                original_name=original_name,
+                size=size,
+                comment=comment,
+                sha256=sha256,
+                blob=blob,
+                path=blob.path
+            )
+            file.save()
+            if not blob.preview:
+                transaction.on_commit(partial(Blob.objects.schedule_preview, blob.pk, original_name))
+        return file
+
+    def delete_files(self, ids, batch_size=500):
+        """
+        Delete the files with the given ids in batches of batch_size rows, each in
+        its own short transaction, releasing their blobs and subtracting them
+        from their owners' usage. Files are removed from storage by
+        the background worker pool after each batch commits. Returns the ids
+        that were deleted.
+        """
+        ids = list(ids)
+        deleted = []
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                rows = list(
+                    self.filter(id__in=ids[start:start + batch_size])
+                    .select_for_update()
+                    .values_list('id', 'blob_id', 'path', 'user_id', 'size')
+                )
+                self.filter(id__in=[row[0] for row in rows]).delete()
+                usage = {}
+                for _, _, _, user_id, size in rows:
+                    total_size, count = usage.get(user_id, (0, 0))
+                    usage[user_id] = (total_size + size, count + 1)
+                # User rows are locked before Blob rows, in the same order as uploads, so the two cannot deadlock.
+                User.objects.remove_usage(usage)
+                Blob.objects.release(Counter(blob_id for _, blob_id, _, _, _ in rows if blob_id))
+                legacy_names = [path for _, blob_id, path, _, _ in rows if not blob_id]
+                transaction.on_commit(partial(delete_stored_in_background, legacy_names))
+            deleted.extend(row[0] for row in rows)
+        return deleted
 
 
 class File(models.Model):
-    data = models.BinaryField()
+    data = models.BinaryField(null=True, editable=False)
     user = models.ForeignKey(User, related_name='files', on_delete=models.CASCADE)
     original_name = models.CharField(max_length=100)
     name = models.CharField(max_length=100, null=True)
-    size = models.IntegerField()
+    size = models.BigIntegerField()
     upload_date = models.DateTimeField(auto_now_add=True)
     last_download_date = models.DateTimeField(null=True)
+    download_count = models.PositiveBigIntegerField(default=0)
     comment = models.TextField(max_length=200)
-    path = models.CharField(max_length=100)
-    special_link = models.CharField(max_length=255)
+    path = models.CharField(max_length=255)
+    share_token = models.CharField(max_length=64, unique=True, null=True, editable=False)
+    # Share links handed out before share_token existed, '/files/<id>/download/<token>/'. Only read by the
+    # backfill_share_tokens command, which moves their tokens to share_token so the links keep working.
+    legacy_special_link = models.CharField(max_length=255, db_column='special_link', blank=True, default='',
+                                           editable=False)
+    sha256 = models.CharField(max_length=64, blank=True)
+    # Files uploaded before content-addressed storage have no blob and live at MEDIA_ROOT/<user_id>/<original_name>.
+    blob = models.ForeignKey(Blob, related_name='files', null=True, on_delete=models.PROTECT)
+
+    objects = FileManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'original_name'], name='file_unique_user_original_name')
+        ]
+        indexes = [
+            models.Index(fields=['user', 'upload_date', 'id'], name='file_user_upload_date_idx'),
+            models.Index(fields=['upload_date', 'id'], name='file_upload_date_idx'),
+            models.Index(fields=['size', 'id'], name='file_size_idx'),
+            models.Index(fields=['last_download_date', 'id'], name='file_last_download_date_idx'),
+            models.Index(fields=['user', 'id'], name='file_user_id_idx'),
+            models.Index(fields=['name', 'id'], name='file_name_idx'),
+            models.Index(fields=['original_name', 'id'], name='file_original_name_idx')
+        ]
 
     def save(self, *args, **kwargs):
-        if not self.path:
-            self.path = os.path.join(settings.MEDIA_ROOT, str(self.user.id), self.original_name)
-        if not self.name:
-            self.name = self.original_name
+        if self._state.adding:
+            if not self.path:
+                self.path = sharded_path(FILES_DIRECTORY, uuid.uuid4().hex)
+            if not self.name:
+                self.name = self.original_name
+            if not self.share_token:
+                self.share_token = new_share_token()
         super().save(*args, **kwargs)
-        if not self.special_link:
-            token = sha256(secrets.token_bytes(16)).hexdigest()
-            self.special_link = f'/files/{self.id}/download/{token}/'
-            super().save(*args, **kwargs)
+
+    @property
+    def special_link(self):
+        if not self.share_token:
+            return ''
+        return f'/files/{self.id}/download/{self.share_token}/'
+
+    @property
+    def full_path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.path)
+
+    @property
+    def encoding(self):
+        return self.blob.encoding if self.blob_id else ''
+
+    def open(self):
+        """Open the file for reading its original content, decompressing it if it is stored compressed."""
+        f = get_storage().open(self.path)
+        if self.encoding:
+            return open_decoded(f, self.encoding)
+        return f
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super(File, self).delete(*args, **kwargs)
+            User.objects.remove_usage({self.user_id: (self.size, 1)})
+            if self.blob_id:
+                Blob.objects.release({self.blob_id: 1})
+            else:
+                transaction.on_commit(partial(delete_stored_in_background, [self.path]))
+        return result
+
+
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, related_name='upload_sessions', on_delete=models.CASCADE)
+    original_name = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    comment = models.TextField(max_length=200, blank=True)
+    # Sorted, non-overlapping [start, end) byte ranges written so far.
+    received = models.JSONField(default=list)
+    # Set while the received file is being copied into the blob store; chunks are refused meanwhile.
+    completing = models.BooleanField(default=False)
+    created_date = models.DateTimeField(auto_now_add=True)
+    expires_date = models.DateTimeField()
+
+    @property
+    def temp_path(self):
+        return os.path.join(blob_temp_directory(), f'session-{self.id}.part')
+
+    @property
+    def received_bytes(self):
+        return sum(end - start for start, end in self.received)
+
+    @property
+    def is_complete(self):
+        return self.size == 0 or self.received == [[0, self.size]]
 
     def delete(self, *args, **kwargs):
-        os.remove(os.path.join(settings.MEDIA_ROOT, str(self.user.id), self.original_name))
-        super(File, self).delete(*args, **kwargs)
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+        super().delete(*args, **kwargs)
@@ -0,0 +1,90 @@
+import base64
+import json
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import F, Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def parse_page_size(value):
+    """Page size from a ?limit= parameter, capped at FILES_MAX_PAGE_SIZE."""
+    if not value:
+        return settings.FILES_PAGE_SIZE
+    if not value.isdigit() or int(value) == 0:
+        raise ValueError('Invalid limit')
+    return min(int(value), settings.FILES_MAX_PAGE_SIZE)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+    if not isinstance(last_id, int):
+        raise InvalidCursor('Invalid cursor')
+    return value, last_id
+
+
+def after_cursor(field, descending, value, last_id):
+    """
+    Condition selecting the rows that follow (value, last_id) when ordering by
+    (field, id). NULLs sort after every value, like PostgreSQL's default btree
+    order, so both directions can be read straight off an index. The OR of the
+    two comparisons is wrapped in an inclusive bound on field, which the planner
+    can start the (field, id) index range at; NULLs get a branch of their own.
+    """
+    if descending:
+        if value is None:
+            return Q(**{f'{field}__isnull': True, 'id__lt': last_id}) | Q(**{f'{field}__isnull': False})
+        return Q(**{f'{field}__lte': value}) & (Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': last_id}))
+    if value is None:
+        return Q(**{f'{field}__isnull': True, 'id__gt': last_id})
+    return (Q(**{f'{field}__gte': value}) & (Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': last_id}))
+            | Q(**{f'{field}__isnull': True}))
+
+
+def keyset_page(queryset, sort, cursor, limit):
+    """
+    Return one page of queryset ordered by sort ('field' or '-field') with id as
+    tie-breaker, starting after cursor, together with the cursor of the next
+    page (None on the last page). The queryset has to yield dicts (values())
+    including the sort field, a model field or an annotation, and id.
+    """
+    field = sort.lstrip('-')
+    descending = sort.startswith('-')
+
+    if descending:
+        queryset = queryset.order_by(F(field).desc(nulls_first=True), '-id')
+    else:
+        queryset = queryset.order_by(F(field).asc(nulls_last=True), 'id')
+
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        if value is not None:
+            try:
+                output_field = queryset.model._meta.get_field(field)
+            except FieldDoesNotExist:
+                # Sorting on an annotation, such as a column of a related model.
+                output_field = queryset.query.annotations[field].output_field
+            try:
+                value = output_field.to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                # to_python() raises TypeError or ValueError rather than ValidationError for some types,
+                # such as a list given for a date.
+                raise InvalidCursor('Invalid cursor')
+        queryset = queryset.filter(after_cursor(field, descending, value, last_id))
+
+    rows = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][field], rows[-1]['id']])
+    return rows, next_cursor
@@ -0,0 +1,140 @@
+import io
+import mimetypes
+import os
+import tempfile
+
+from django.conf import settings
+
+from ..logger import logger
+from .layout import sharded_path
+from .storage import blob_temp_directory, get_storage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+PREVIEWS_DIRECTORY = 'previews'
+
+PREVIEW_IMAGE = 'image'
+PREVIEW_TEXT = 'text'
+# Generation was attempted and the content has no preview.
+PREVIEW_NONE = 'none'
+
+PREVIEW_CONTENT_TYPES = {
+    PREVIEW_IMAGE: 'image/jpeg',
+    PREVIEW_TEXT: 'text/plain; charset=utf-8'
+}
+
+IMAGE_EXTENSIONS = frozenset(('bmp', 'gif', 'jpeg', 'jpg', 'png', 'tif', 'tiff', 'webp'))
+
+TEXT_EXTENSIONS = frozenset((
+    'cfg', 'conf', 'csv', 'ini', 'js', 'json', 'log', 'md', 'py', 'sh', 'sql', 'toml', 'ts', 'tsv', 'txt', 'xml',
+    'yaml', 'yml'
+))
+
+
+def preview_name(key, kind):
+    """Storage name of the preview of the blob with the given key, shared by every file with its content."""
+    extension = '.jpg' if kind == PREVIEW_IMAGE else '.txt'
+    return sharded_path(PREVIEWS_DIRECTORY, key, extension)
+
+
+def preview_source(name):
+    """What a file's preview is made from, judged by its name: 'image', 'pdf', 'text' or None."""
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+    if extension in IMAGE_EXTENSIONS:
+        return 'image'
+    if extension == 'pdf':
+        return 'pdf'
+    content_type = mimetypes.guess_type(name)[0] or ''
+    if extension in TEXT_EXTENSIONS or content_type.startswith('text/'):
+        return 'text'
+    return None
+
+
+def seekable(f, size):
+    """f itself if it can seek, else its contents in memory if they are small enough, else None."""
+    if f.seekable():
+        return f
+    if size > settings.FILES_PREVIEW_MAX_SOURCE_SIZE:
+        return None
+    return io.BytesIO(f.read())
+
+
+def image_thumbnail(f):
+    if Image is None:
+        return None
+    max_size = settings.FILES_PREVIEW_SIZE
+    with Image.open(f) as image:
+        image.draft('RGB', (max_size, max_size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        image.convert('RGB').save(output, 'JPEG', quality=80, optimize=True)
+    return output.getvalue()
+
+
+def text_snippet(f):
+    sample = f.read(settings.FILES_PREVIEW_TEXT_CHARS * 4)
+    if b'\x00' in sample:
+        return None
+    return sample.decode('utf-8', errors='replace')[:settings.FILES_PREVIEW_TEXT_CHARS].encode('utf-8')
+
+
+def pdf_snippet(f):
+    if pypdf is None:
+        return None
+    reader = pypdf.PdfReader(f)
+    if not reader.pages:
+        return None
+    text = reader.pages[0].extract_text() or ''
+    return text.strip()[:settings.FILES_PREVIEW_TEXT_CHARS].encode('utf-8') or None
+
+
+def render_preview(open_file, name, key, size):
+    """
+    Build the preview of a file: a JPEG thumbnail for images, the start of the
+    text for text files and of the first page's text for PDFs. Pillow and pypdf
+    are optional; without them images and PDFs get no preview. The preview is
+    saved to storage under preview_name(). Returns its kind, PREVIEW_NONE if
+    the file has no preview.
+    """
+    source = preview_source(name)
+    if source is None:
+        return PREVIEW_NONE
+
+    with open_file() as f:
+        if source == 'text':
+            kind, data = PREVIEW_TEXT, text_snippet(f)
+        else:
+            f = seekable(f, size)
+            if f is None:
+                return PREVIEW_NONE
+            if source == 'image':
+                kind, data = PREVIEW_IMAGE, image_thumbnail(f)
+            else:
+                kind, data = PREVIEW_TEXT, pdf_snippet(f)
+    if not data:
+        return PREVIEW_NONE
+
+    stored_name = preview_name(key, kind)
+    os.makedirs(blob_temp_directory(), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=blob_temp_directory(), prefix='.preview-', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            output.write(data)
+        get_storage().save(temp_path, stored_name)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    logger.debug('Rendered %s preview of %s to %s', kind, name, stored_name)
+    return kind
@@ -0,0 +1,77 @@
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.models import Q
+from django.db.models.functions import Greatest, Upper
+
+from ..logger import logger
+from .models import File
+
+# GIN trigram indexes over the same UPPER(column) expression icontains compiles to
+# on PostgreSQL, so both substring (LIKE) and similarity (%) matches can use them.
+TRIGRAM_INDEXES = (
+    ('file_name_trgm_idx', 'name'),
+    ('file_original_name_trgm_idx', 'original_name'),
+)
+
+_trigram_available = {}
+
+
+def create_trigram_indexes(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    post_migrate handler enabling pg_trgm and building the trigram indexes,
+    concurrently so a live table is not locked. Does nothing on other databases.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DatabaseError:
+            logger.warning('Could not enable pg_trgm, file name search falls back to sequential scans')
+            return
+        for index_name, column in TRIGRAM_INDEXES:
+            cursor.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} '
+                f'ON {File._meta.db_table} USING gin (UPPER({column}::text) gin_trgm_ops)'
+            )
+    _trigram_available.pop(using, None)
+
+
+def trigram_available(using=DEFAULT_DB_ALIAS):
+    if using not in _trigram_available:
+        connection = connections[using]
+        available = False
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                available = cursor.fetchone() is not None
+        _trigram_available[using] = available
+    return _trigram_available[using]
+
+
+def search_files(queryset, query, limit):
+    """
+    Files from queryset whose name or original_name contains query, or is
+    similar to it, best matches first. Falls back to a plain case-insensitive
+    substring match ordered by name where pg_trgm is not available.
+    """
+    if not trigram_available(queryset.db):
+        logger.debug('pg_trgm not available, searching with icontains')
+        return (queryset.filter(Q(name__icontains=query) | Q(original_name__icontains=query))
+                .order_by('name', 'id')[:limit])
+
+    from django.contrib.postgres.search import TrigramSimilarity
+
+    upper_query = query.upper()
+    return (
+        queryset
+        .annotate(upper_name=Upper('name'), upper_original_name=Upper('original_name'))
+        .filter(
+            Q(name__icontains=query) | Q(original_name__icontains=query)
+            | Q(upper_name__trigram_similar=upper_query) | Q(upper_original_name__trigram_similar=upper_query)
+        )
+        .annotate(similarity=Greatest(TrigramSimilarity('upper_name', upper_query),
+                                      TrigramSimilarity('upper_original_name', upper_query)))
+        .order_by('-similarity', 'id')[:limit]
+    )
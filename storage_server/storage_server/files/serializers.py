@@ -1,7 +1,34 @@
 from rest_framework import serializers
+from django.urls import reverse
 from .models import File
+from .previews import PREVIEW_CONTENT_TYPES
 
 class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+# Columns needed to list files, fetched with values() so listings never touch contents.
+FILE_LIST_FIELDS = ('id', 'name', 'comment', 'size', 'upload_date', 'last_download_date', 'sha256', 'blob__preview')
+
+
+def preview_url(file_id, sha256, preview):
+    """
+    URL of a file's preview, None if it has none. Versioned with the content
+    digest so browsers can cache it forever.
+    """
+    if preview not in PREVIEW_CONTENT_TYPES:
+        return None
+    return f"{reverse('file-preview', args=[file_id])}?v={sha256[:16]}"
+
+
+def file_list_data(file):
+    return {
+        'id': file['id'],
+        'name': file['name'],
+        'comment': file['comment'],
+        'size': file['size'],
+        'upload_date': str(file['upload_date']),
+        'last_download_date': str(file['last_download_date']),
+        'preview_url': preview_url(file['id'], file['sha256'], file['blob__preview'])
+    }
@@ -0,0 +1,320 @@
+import asyncio
+import mimetypes
+import os
+import re
+import secrets
+from functools import partial
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from ..logger import logger
+from .storage import get_storage
+
+SERVE_MODE_DJANGO = 'django'
+SERVE_MODE_X_ACCEL_REDIRECT = 'x-accel-redirect'
+SERVE_MODE_X_SENDFILE = 'x-sendfile'
+SERVE_MODE_REDIRECT = 'redirect'
+
+# Requests asking for more ranges than this get the whole file instead.
+MAX_RANGES = 16
+
+CHUNK_SIZE = 256 * 2 ** 10
+
+RANGE_SPEC_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(header, size):
+    """
+    Parse a Range header into a sorted list of coalesced inclusive (start, end)
+    byte ranges. Returns None when the header is absent, malformed or not worth
+    honouring (the whole file should be sent), and an empty list when none of
+    the ranges can be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        match = RANGE_SPEC_RE.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if not first:
+            if not last:
+                return None
+            suffix_length = int(last)
+            if suffix_length and size:
+                ranges.append((max(size - suffix_length, 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+
+    ranges.sort()
+    coalesced = []
+    for start, end in ranges:
+        if coalesced and start <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], end))
+        else:
+            coalesced.append((start, end))
+    return coalesced
+
+
+def if_range_matches(request, etag, last_modified):
+    """Whether the Range header may be honoured given the request's If-Range validator."""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # If-Range requires a strong comparison, weak tags never match.
+        return etag is not None and if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def accepts_encoding(request, encoding):
+    """Whether the request's Accept-Encoding allows a response in encoding."""
+    accepted = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted.get(encoding, accepted.get('*', 0.0)) > 0
+
+
+def iter_file_range(open_file, start, end):
+    """Yield bytes start to end inclusive of the file returned by open_file()."""
+    with open_file() as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def iter_file(open_file):
+    with open_file() as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+async def aiter_sync(iterator):
+    """
+    Drive a blocking iterator from async code, running each step in a worker
+    thread so file reads never block the event loop.
+    """
+    try:
+        while (chunk := await asyncio.to_thread(next, iterator, None)) is not None:
+            yield chunk
+    finally:
+        iterator.close()
+
+
+def iter_multipart_ranges(open_file, ranges, size, boundary):
+    for start, end in ranges:
+        yield (f'\r\n--{boundary}\r\n'
+               f'Content-Type: application/octet-stream\r\n'
+               f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('ascii')
+        yield from iter_file_range(open_file, start, end)
+    yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+def multipart_ranges_length(ranges, size, boundary):
+    length = len(f'\r\n--{boundary}--\r\n')
+    for start, end in ranges:
+        length += len(f'\r\n--{boundary}\r\n'
+                      f'Content-Type: application/octet-stream\r\n'
+                      f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n')
+        length += end - start + 1
+    return length
+
+
+def range_response(request, file, etag, last_modified, content_type='application/octet-stream', asynchronous=False):
+    """
+    Build a streamed response for the Range request, if it carries one that
+    should be honoured. Returns None when the whole file should be sent.
+    With asynchronous=True the body is an async iterator, for ASGI views.
+    """
+    stream = aiter_sync if asynchronous else iter
+    if 'HTTP_RANGE' not in request.META or not if_range_matches(request, etag, last_modified):
+        return None
+
+    size = file.size
+    ranges = parse_range_header(request.META['HTTP_RANGE'], size)
+    if ranges is None:
+        return None
+
+    if not ranges:
+        logger.debug('Requested range not satisfiable')
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        logger.debug('Streaming range %s-%s of %s bytes', start, end, size)
+        response = StreamingHttpResponse(stream(iter_file_range(file.open, start, end)), status=206,
+                                         content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+        return response
+
+    logger.debug('Streaming %s ranges of %s bytes as multipart/byteranges', len(ranges), size)
+    boundary = secrets.token_hex(16)
+    response = StreamingHttpResponse(stream(iter_multipart_ranges(file.open, ranges, size, boundary)), status=206,
+                                     content_type=f'multipart/byteranges; boundary={boundary}')
+    response['Content-Length'] = multipart_ranges_length(ranges, size, boundary)
+    return response
+
+
+def counts_as_download(request, response, size):
+    """
+    Whether response sends the file from its first byte, and so counts as a
+    download. Range requests starting further in resume or seek within a
+    transfer and are not counted, whether Django answers them or, in the
+    proxy modes, the proxy does.
+    """
+    if response.status_code not in (200, 206):
+        return False
+    if response.status_code == 200:
+        delegated = response.has_header('X-Accel-Redirect') or response.has_header('X-Sendfile')
+        last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+        if not delegated or not if_range_matches(request, response.get('ETag'), last_modified):
+            return True
+    ranges = parse_range_header(request.META.get('HTTP_RANGE'), size)
+    return ranges is None or bool(ranges) and ranges[0][0] == 0
+
+
+def serve_file(request, file, as_attachment=True, asynchronous=False):
+    """
+    Build the download response for file according to settings.FILES_SERVE_MODE.
+
+    Responses carry a strong ETag built from the stored content digest and
+    a Last-Modified date, and conditional requests are answered with 304 or 412
+    before the file is opened.
+
+    In 'django' mode the file object is handed to the server through
+    wsgi.file_wrapper, which lets servers such as gunicorn use sendfile(2),
+    and Range/If-Range requests get 206 responses, multipart/byteranges for
+    several ranges. The proxy modes return an empty response whose header
+    tells nginx (X-Accel-Redirect) or Apache/lighttpd (X-Sendfile) to send the
+    file itself, ranges included, so the worker is released before the
+    transfer starts. They need the local storage backend. In 'redirect' mode
+    the client is redirected to a short-lived presigned URL of the object in
+    the storage backend, so the bytes never pass through the worker; with
+    local storage files are sent as in 'django' mode.
+
+    Files stored compressed are sent as stored, with Content-Encoding, to
+    clients accepting their encoding. For the rest they are decompressed on
+    the fly by Django, also in the proxy modes, and Range requests are always
+    answered from the original bytes. Both representations vary on
+    Accept-Encoding and have their own ETag.
+
+    With as_attachment=False the file is served inline with a Content-Type
+    guessed from its name, for the browser to display. Uploaded HTML or SVG
+    then runs in a sandbox rather than with the site's origin.
+
+    With asynchronous=True file contents are streamed by an async iterator
+    reading in worker threads, which ASGI servers consume without tying up a
+    thread per transfer.
+    """
+    encoding = file.encoding
+    send_encoded = bool(encoding) and 'HTTP_RANGE' not in request.META and accepts_encoding(request, encoding)
+    etag = None
+    if file.sha256:
+        etag = f'"{file.sha256}-{encoding}"' if send_encoded else f'"{file.sha256}"'
+    last_modified = int(file.upload_date.timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        logger.debug('Conditional request answered with %s', response.status_code)
+        if etag:
+            response['ETag'] = etag
+        if encoding:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    content_type = 'application/octet-stream'
+    if not as_attachment:
+        content_type = mimetypes.guess_type(file.original_name)[0] or content_type
+
+    mode = settings.FILES_SERVE_MODE
+    stream = aiter_sync if asynchronous else iter
+    storage = get_storage()
+    # The stored bytes can be handed off as they are unless they must be decompressed first.
+    send_stored = send_encoded or not encoding
+
+    redirect_url = None
+    if mode == SERVE_MODE_REDIRECT and send_stored:
+        redirect_url = storage.url(file.path, file.original_name, as_attachment, content_type,
+                                   encoding if send_encoded else '')
+    if redirect_url:
+        logger.debug('Redirecting file transfer to storage backend')
+        response = HttpResponseRedirect(redirect_url)
+        # The presigned URL expires, so the redirect must not be reused.
+        response['Cache-Control'] = 'private, no-store'
+        if encoding:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    if mode == SERVE_MODE_X_ACCEL_REDIRECT and send_stored and storage.local:
+        logger.debug('Delegating file transfer to proxy with X-Accel-Redirect')
+        relative_path = os.path.relpath(storage.path(file.path), settings.MEDIA_ROOT)
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(settings.FILES_ACCEL_REDIRECT_PREFIX + relative_path)
+    elif mode == SERVE_MODE_X_SENDFILE and send_stored and storage.local:
+        logger.debug('Delegating file transfer to proxy with X-Sendfile')
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = storage.path(file.path)
+    elif send_encoded:
+        logger.debug('Sending file as stored with Content-Encoding %s', encoding)
+        open_stored = partial(storage.open, file.path)
+        if asynchronous:
+            response = StreamingHttpResponse(stream(iter_file(open_stored)), content_type=content_type)
+            response['Content-Length'] = storage.size(file.path)
+        else:
+            response = FileResponse(open_stored(), content_type=content_type)
+    else:
+        response = range_response(request, file, etag, last_modified, content_type, asynchronous)
+        if response is None and (asynchronous or encoding):
+            logger.debug('Streaming file contents')
+            response = StreamingHttpResponse(stream(iter_file(file.open)), content_type=content_type)
+            response['Content-Length'] = file.size
+        elif response is None:
+            logger.debug('Streaming file through wsgi.file_wrapper')
+            response = FileResponse(file.open(), content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+
+    if send_encoded:
+        response['Content-Encoding'] = encoding
+    if encoding:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if etag:
+        response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Content-Disposition'] = content_disposition_header(as_attachment, file.original_name)
+    if not as_attachment:
+        response['X-Content-Type-Options'] = 'nosniff'
+        response['Content-Security-Policy'] = 'sandbox'
+    return response
@@ -0,0 +1,101 @@
+import atexit
+import os
+import threading
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, DateTimeField, F, PositiveBigIntegerField, Value, When
+
+from ..logger import logger
+from .models import File
+
+# Rows updated per UPDATE statement when flushing.
+FLUSH_BATCH_SIZE = 500
+
+
+class DownloadStats:
+    """
+    In-process buffer of download events. Downloads only record the event in
+    memory; a background thread coalesces them per file and writes
+    last_download_date and download_count in batched UPDATEs every
+    FILES_DOWNLOAD_STATS_FLUSH_INTERVAL seconds, or sooner once
+    FILES_DOWNLOAD_STATS_MAX_PENDING files are waiting. Events not yet flushed
+    are lost if the process is killed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = {}
+        self._pid = None
+
+    def record(self, file_id):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            entry = self._pending.get(file_id)
+            if entry:
+                entry[0] = now
+                entry[1] += 1
+            else:
+                self._pending[file_id] = [now, 1]
+            pending = len(self._pending)
+        if pending >= settings.FILES_DOWNLOAD_STATS_MAX_PENDING:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        items = list(pending.items())
+        for start in range(0, len(items), FLUSH_BATCH_SIZE):
+            batch = items[start:start + FLUSH_BATCH_SIZE]
+            try:
+                File.objects.filter(id__in=[file_id for file_id, _ in batch]).update(
+                    last_download_date=Case(
+                        *[When(id=file_id, then=Value(date)) for file_id, (date, _) in batch],
+                        output_field=DateTimeField()
+                    ),
+                    download_count=F('download_count') + Case(
+                        *[When(id=file_id, then=Value(count)) for file_id, (_, count) in batch],
+                        default=Value(0), output_field=PositiveBigIntegerField()
+                    )
+                )
+            except Exception:
+                logger.exception('Flushing download stats failed, keeping %s files for the next flush',
+                                 len(items) - start)
+                self._restore(dict(items[start:]))
+                return
+        logger.debug('Flushed download stats for %s files', len(pending))
+
+    def _restore(self, pending):
+        with self._lock:
+            for file_id, (date, count) in pending.items():
+                entry = self._pending.get(file_id)
+                if entry:
+                    entry[1] += count
+                else:
+                    self._pending[file_id] = [date, count]
+
+    def _start(self):
+        # Called with the lock held, once per process, so forked workers get their own thread.
+        self._pid = os.getpid()
+        self._pending = {}
+        thread = threading.Thread(target=self._run, name='download-stats', daemon=True)
+        thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(settings.FILES_DOWNLOAD_STATS_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+            close_old_connections()
+
+
+download_stats = DownloadStats()
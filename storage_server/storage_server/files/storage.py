@@ -0,0 +1,260 @@
+import io
+import os
+import threading
+
+from django.conf import settings
+from django.utils.http import content_disposition_header
+
+from ..logger import logger
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+BLOBS_DIRECTORY = 'blobs'
+
+STORAGE_LOCAL = 'local'
+STORAGE_S3 = 's3'
+
+# Keys per DeleteObjects request, the most S3 accepts.
+S3_DELETE_BATCH_SIZE = 1000
+
+_lock = threading.Lock()
+_storages = {}
+
+
+def blob_temp_directory():
+    """
+    Directory for partially received uploads. It is always on local disk, on the
+    same filesystem as local blobs so storing one is a rename.
+    """
+    return os.path.join(settings.MEDIA_ROOT, BLOBS_DIRECTORY, 'tmp')
+
+
+class LocalStorage:
+    """Stored files under MEDIA_ROOT, named by their path relative to it."""
+
+    local = True
+
+    def path(self, name):
+        return os.path.join(settings.MEDIA_ROOT, name)
+
+    def save(self, temp_path, name):
+        """Move the local file temp_path into storage as name, replacing any file stored under it."""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def delete(self, names):
+        for name in names:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.exception('Could not remove %s', name)
+
+    def url(self, name, filename, as_attachment, content_type, encoding=''):
+        """Local files have no URL of their own; they are sent by Django or the front proxy."""
+        return None
+
+
+S3_NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+
+def raise_not_found(error, key):
+    """Re-raise a botocore ClientError, as FileNotFoundError when it is about a missing object."""
+    if error.response['Error']['Code'] in S3_NOT_FOUND_CODES:
+        raise FileNotFoundError(f'No such object: {key}') from error
+    raise error
+
+
+class S3File(io.RawIOBase):
+    """
+    Read-only, seekable file over an S3 object. Reads stream a ranged GET from
+    the current position, and seeking drops it so the next read starts a new one.
+    """
+
+    def __init__(self, client, bucket, key, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.name = key
+        self._size = size
+        self._position = 0
+        self._body = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            try:
+                self._size = self.client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+            except ClientError as e:
+                raise_not_found(e, self.key)
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset != self._position:
+            self._close_body()
+            self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._body is None:
+            if self._size is not None and self._position >= self._size:
+                return 0
+            try:
+                response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={self._position}-')
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'InvalidRange':
+                    return 0
+                raise_not_found(e, self.key)
+            self._body = response['Body']
+            if self._size is None and 'ContentRange' in response:
+                self._size = int(response['ContentRange'].rpartition('/')[2])
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+class S3Storage:
+    """
+    Stored files as objects in an S3-compatible bucket, keyed by FILES_S3_PREFIX
+    and their name. Files are uploaded with parallel multipart uploads, read with
+    ranged GETs and can be downloaded straight from the bucket with presigned
+    URLs. Works with MinIO and other S3 clones through FILES_S3_ENDPOINT_URL.
+    """
+
+    local = False
+
+    def __init__(self):
+        if boto3 is None:
+            raise RuntimeError('boto3 is required for FILES_STORAGE_BACKEND=s3')
+        self.bucket = settings.FILES_S3_BUCKET
+        self.prefix = settings.FILES_S3_PREFIX
+        self.client = boto3.client(
+            's3',
+            endpoint_url=settings.FILES_S3_ENDPOINT_URL or None,
+            region_name=settings.FILES_S3_REGION or None,
+            aws_access_key_id=settings.FILES_S3_ACCESS_KEY_ID or None,
+            aws_secret_access_key=settings.FILES_S3_SECRET_ACCESS_KEY or None,
+            config=Config(
+                s3={'addressing_style': settings.FILES_S3_ADDRESSING_STYLE},
+                max_pool_connections=max(10, settings.FILES_S3_MAX_CONCURRENCY * 2)
+            )
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.FILES_S3_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=settings.FILES_S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=settings.FILES_S3_MAX_CONCURRENCY,
+            use_threads=True
+        )
+
+    def key(self, name):
+        return self.prefix + name
+
+    def path(self, name):
+        return None
+
+    def save(self, temp_path, name):
+        """Upload the local file temp_path as name, in parallel parts if it is large, and remove it."""
+        self.client.upload_file(temp_path, self.bucket, self.key(name), Config=self.transfer_config)
+        os.remove(temp_path)
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in S3_NOT_FOUND_CODES:
+                return False
+            raise
+        return True
+
+    def size(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))['ContentLength']
+        except ClientError as e:
+            raise_not_found(e, self.key(name))
+
+    def open(self, name):
+        return io.BufferedReader(S3File(self.client, self.bucket, self.key(name)), buffer_size=256 * 2 ** 10)
+
+    def delete(self, names):
+        keys = [self.key(name) for name in names]
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + S3_DELETE_BATCH_SIZE]],
+                'Quiet': True
+            })
+            for error in response.get('Errors', []):
+                logger.error('Could not remove %s: %s', error['Key'], error.get('Message'))
+
+    def url(self, name, filename, as_attachment, content_type, encoding=''):
+        """Presigned GET URL serving the object under filename with the given headers."""
+        params = {
+            'Bucket': self.bucket,
+            'Key': self.key(name),
+            'ResponseContentDisposition': content_disposition_header(as_attachment, filename),
+            'ResponseContentType': content_type
+        }
+        if encoding:
+            params['ResponseContentEncoding'] = encoding
+        return self.client.generate_presigned_url('get_object', Params=params,
+                                                  ExpiresIn=settings.FILES_S3_PRESIGNED_EXPIRY)
+
+
+STORAGE_BACKENDS = {
+    STORAGE_LOCAL: LocalStorage,
+    STORAGE_S3: S3Storage
+}
+
+
+def get_storage():
+    """
+    The storage backend selected by settings.FILES_STORAGE_BACKEND, one instance
+    per process since S3 clients must not be shared across fork().
+    """
+    backend = settings.FILES_STORAGE_BACKEND
+    key = (backend, os.getpid())
+    with _lock:
+        if key not in _storages:
+            if backend not in STORAGE_BACKENDS:
+                raise RuntimeError(f'Unknown FILES_STORAGE_BACKEND {backend!r}')
+            _storages[key] = STORAGE_BACKENDS[backend]()
+        return _storages[key]
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers, StopUpload
+
+from ..logger import logger
+from .compression import compressor, storage_encoding, worth_compressing
+
+CHUNK_SIZE = 256 * 2 ** 10
+
+# Room left in an upload's Content-Length for the multipart framing and the form fields around the file.
+UPLOAD_OVERHEAD_ALLOWANCE = 64 * 2 ** 10
+
+
+def upload_exceeds_quota(request, user):
+    """Whether the request body is too large to fit in the user's remaining quota, judged from Content-Length."""
+    available = user.available_bytes
+    length = request.META.get('CONTENT_LENGTH', '')
+    return available is not None and length.isdigit() and int(length) > available + UPLOAD_OVERHEAD_ALLOWANCE
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hashed_copy(path, name):
+    """
+    Copy the file at path to a new temporary file next to it, compressed if
+    compression is enabled and its content, judged with name, is worth it, and
+    hash the original bytes in the same pass. Returns the copy's path, its
+    encoding ('' when stored as is) and the digest of exactly what was copied,
+    which writes to path still in flight cannot change.
+    """
+    encoding = storage_encoding()
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as source:
+        chunk = source.read(CHUNK_SIZE)
+        if not encoding or not worth_compressing(name, chunk):
+            encoding = ''
+        fd, copy_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.copy-', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                stream = compressor(encoding) if encoding else None
+                while chunk:
+                    hasher.update(chunk)
+                    target.write(stream.compress(chunk) if stream else chunk)
+                    chunk = source.read(CHUNK_SIZE)
+                if stream:
+                    target.write(stream.flush())
+        except BaseException:
+            os.remove(copy_path)
+            raise
+    logger.debug('Copied %s with encoding %r', path, encoding)
+    return copy_path, encoding, hasher.hexdigest()
+
+
+def write_chunk(path, offset, stream, length):
+    """
+    Copy length bytes from stream into the file at path starting at offset,
+    CHUNK_SIZE at a time. Returns the number of bytes actually written.
+    """
+    written = 0
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while written < length:
+            chunk = stream.read(min(CHUNK_SIZE, length - written))
+            if not chunk:
+                break
+            os.pwrite(fd, chunk, offset + written)
+            written += len(chunk)
+    finally:
+        os.close(fd)
+    return written
+
+
+def merge_range(ranges, start, end):
+    """Add the [start, end) range to a sorted list of disjoint ranges, merging neighbours."""
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append([range_start, range_end])
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+
+class StreamedUploadedFile(UploadedFile):
+    """
+    An uploaded file whose bytes were written to a temporary file next to their
+    final location while the request body was being parsed.
+    """
+
+    def __init__(self, file, name, content_type, size, charset, sha256, content_encoding='',
+                 content_type_extra=None):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.sha256 = sha256
+        # Compression the temporary file is written with, '' when it holds the raw bytes.
+        self.content_encoding = content_encoding
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+class StreamingFileUploadHandler(FileUploadHandler):
+    """
+    Upload handler that writes every chunk straight to a temporary file in the
+    target directory, hashing and counting bytes as they arrive, so memory use
+    per upload is bounded by the chunk size.
+
+    Once more than max_size bytes of file data have arrived the file is
+    removed, quota_exceeded is set and the rest of the body is discarded.
+
+    With FILES_COMPRESSION enabled, files whose first chunk compresses well
+    are written compressed as they stream in; the digest and size remain
+    those of the original bytes.
+    """
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, request=None, directory=None, max_size=None):
+        super().__init__(request)
+        self.directory = directory
+        self.max_size = max_size
+        self.total_received = 0
+        self.quota_exceeded = False
+        self.encoding = storage_encoding()
+        self.file = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='.upload-', suffix='.part')
+        os.close(fd)
+        self.file = open(path, 'wb+')
+        self.hasher = hashlib.sha256()
+        self.received = 0
+        self.compressor = None
+        logger.debug('Streaming upload %s to %s', self.file_name, path)
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.total_received += len(raw_data)
+        if self.max_size is not None and self.total_received > self.max_size:
+            logger.error('Upload exceeds %s bytes, removing %s', self.max_size, self.file.name)
+            self.quota_exceeded = True
+            self.file.close()
+            os.remove(self.file.name)
+            raise StopUpload()
+        if self.received == 0 and self.encoding and worth_compressing(self.file_name, raw_data):
+            logger.debug('Compressing upload %s with %s', self.file_name, self.encoding)
+            self.compressor = compressor(self.encoding)
+        self.file.write(self.compressor.compress(raw_data) if self.compressor else raw_data)
+        self.hasher.update(raw_data)
+        self.received += len(raw_data)
+
+    def file_complete(self, file_size):
+        if self.compressor:
+            self.file.write(self.compressor.flush())
+        self.file.flush()
+        self.file.seek(0)
+        uploaded = StreamedUploadedFile(
+            file=self.file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.received,
+            charset=self.charset,
+            sha256=self.hasher.hexdigest(),
+            content_encoding=self.encoding if self.compressor else '',
+            content_type_extra=self.content_type_extra
+        )
+        self.file = None
+        return uploaded
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            logger.error('Upload interrupted, removing %s', self.file.name)
+            self.file.close()
+            os.remove(self.file.name)
+            self.file = None
@@ -1,16 +1,36 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+if settings.FILES_ASYNC_VIEWS:
+    UploadView = async_views.AsyncUploadView
+    DownloadView = async_views.AsyncDownloadView
+    DownloadSpecialView = async_views.AsyncDownloadSpecialView
+else:
+    UploadView = views.UploadView
+    DownloadView = views.DownloadView
+    DownloadSpecialView = views.DownloadSpecialView
 
 urlpatterns = [
     path('', views.ListView.as_view(), name='file-list'),
     path('get/', views.GetFilesView.as_view(), name='files-get'),
-    path('upload/', views.UploadView.as_view(), name='file-upload'),
+    path('search/', views.SearchFilesView.as_view(), name='files-search'),
+    path('bulk/', views.BulkFilesView.as_view(), name='files-bulk'),
+    path('archive/', views.ArchiveView.as_view(), name='files-archive'),
+    path('usage/', views.UsageView.as_view(), name='files-usage'),
+    path('upload/', UploadView.as_view(), name='file-upload'),
+    path('uploads/', views.UploadSessionsView.as_view(), name='upload-sessions'),
+    path('uploads/<uuid:session_id>/', views.UploadSessionView.as_view(), name='upload-session'),
+    path('uploads/<uuid:session_id>/complete/', views.CompleteUploadSessionView.as_view(),
+         name='upload-session-complete'),
     path('<int:file_id>/', views.DetailView.as_view(), name='file-detail'),
     path('<int:file_id>/get/', views.GetFileView.as_view(), name='file-get'),
+    path('<int:file_id>/content/', views.FileContentView.as_view(), name='file-content'),
+    path('<int:file_id>/preview/', views.PreviewView.as_view(), name='file-preview'),
     path('<int:file_id>/delete/', views.DeleteView.as_view(), name='file-delete'),
     path('<int:file_id>/rename/', views.RenameView.as_view(), name='file-rename'),
     path('<int:file_id>/comment/', views.CommentView.as_view(), name='file-comment'),
     path('<int:file_id>/special/', views.NewSpecialLinkView.as_view(), name='file-new-link'),
-    path('<int:file_id>/download/', views.DownloadView.as_view(), name='file-download'),
-    path('<int:file_id>/download/<str:_>/', views.DownloadSpecialView.as_view(), name='download-special')
+    path('<int:file_id>/download/', DownloadView.as_view(), name='file-download'),
+    path('<int:file_id>/download/<str:token>/', DownloadSpecialView.as_view(), name='download-special')
 ]
@@ -1,17 +1,33 @@
 import json
 from django.shortcuts import get_object_or_404
-from django.http import JsonResponse, HttpResponseBadRequest, HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.views import View
-from .models import File
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from .archive import iter_zip
+from .models import Blob, File, QuotaExceeded, UploadSession, blob_temp_directory, new_share_token
+from .previews import PREVIEW_CONTENT_TYPES
+from .pagination import InvalidCursor, keyset_page, parse_page_size
+from .serializers import FILE_LIST_FIELDS, file_list_data, preview_url
+from .search import search_files
+from .serving import counts_as_download, serve_file
+from .storage import get_storage
+from .stats import download_stats
+from .uploads import StreamingFileUploadHandler, hashed_copy, merge_range, upload_exceeds_quota, write_chunk
+from .workers import delete_stored_in_background, remove_files
 from ..accounts.models import User
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import os
+import re
 from django.conf import settings
 from ..logger import logger
 from django.shortcuts import render
-import base64
+from django.urls import reverse
 
 
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
@@ -22,13 +38,29 @@ class ListView(View):
         return render(request, 'index.html')
 
 
+@method_decorator(csrf_exempt, name='dispatch')
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class UploadView(View):
+    def dispatch(self, request, *args, **kwargs):
+        # Upload handlers have to be swapped before anything reads request.POST,
+        # so CSRF protection is applied here instead of in the middleware.
+        if request.method == 'POST' and upload_exceeds_quota(request, request.user):
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+        request.upload_handlers = [
+            StreamingFileUploadHandler(request, blob_temp_directory(), max_size=request.user.available_bytes)
+        ]
+        return csrf_protect(super().dispatch)(request, *args, **kwargs)
+
     def post(self, request):
         logger.debug('Entering UploadView.post function')
         file = request.FILES.get('file')
         comment = request.POST.get('comment')
 
+        if request.upload_handlers[0].quota_exceeded:
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+
         if not file:
             logger.error('No file provided')
             return HttpResponseBadRequest(json.dumps({'error': 'No file provided'}), content_type='application/json')
@@ -37,41 +69,28 @@ class UploadView(View):
             logger.debug('Empty comment')
             comment = ''
 
-        logger.debug('Reading file_content...')
-        file_content = file.read()
-        logger.debug('Finished reading file_content')
-        logger.debug('Initiating filename...')
-        filename = os.path.join(settings.MEDIA_ROOT, str(request.user.id), file.name)
-        logger.debug('Initiated filename')
-
-        if os.path.exists(filename):
+        if File.objects.filter(user=request.user, original_name=file.name).exists():
+            file.discard()
             logger.error('File with this name already exists')
             return HttpResponseBadRequest(json.dumps({'error': 'File with this name already exists'}),
                                           content_type='application/json')
 
-        logger.debug('Creating filename...')
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        logger.debug('Created filename')
-
-        logger.debug('Starting writing file_content...')
-        with open(filename, 'wb') as f:
-            f.write(file_content)
-        logger.debug('Finished writing file_content')
-        logger.debug(f"Creating uploaded file: user={request.user}, original_name={file.name}, size={file.size}"
-                     f", comment={comment}, file_path={os.path.join(str(request.user.id), file.name)}...")
-        uploaded_file = File(
-            user=request.user,
-            original_name=file.name,
-            size=file.size,
-            comment=comment,
-            data=file_content,
-            path=os.path.join(str(request.user.id), file.name)
-        )
-        logger.debug('Created uploaded file')
-
-        logger.debug('Uploaded file saving to DB...')
-        uploaded_file.save()
-        logger.debug('Uploaded file saved to DB')
+        logger.debug('Creating uploaded file: user=%s, original_name=%s, size=%s, comment=%s, sha256=%s...',
+                     request.user, file.name, file.size, comment, file.sha256)
+        file.close()
+        try:
+            File.objects.create_from_temp(request.user, file.name, comment, file.temporary_file_path(),
+                                          file.sha256, file.size, file.content_encoding)
+        except QuotaExceeded:
+            file.discard()
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+        except IntegrityError:
+            file.discard()
+            logger.error('File with this name already exists')
+            return HttpResponseBadRequest(json.dumps({'error': 'File with this name already exists'}),
+                                          content_type='application/json')
+        logger.debug('Created uploaded file and saved it to DB')
 
         logger.debug('Exiting UploadView.post function and responding with "message": "File uploaded successfully"')
         return JsonResponse({'message': 'File uploaded successfully'})
@@ -82,6 +101,212 @@ class UploadView(View):
         return render(request, 'index.html')
 
 
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def upload_session_data(session):
+    return {
+        'id': str(session.id),
+        'name': session.original_name,
+        'size': session.size,
+        'received': session.received,
+        'received_bytes': session.received_bytes,
+        'completing': session.completing,
+        'expires_date': str(session.expires_date)
+    }
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class UploadSessionsView(View):
+    def post(self, request):
+        logger.debug('Entering UploadSessionsView.post function')
+        data = json.loads(request.body)
+        name = os.path.basename(data.get('name') or '')
+        size = data.get('size')
+        comment = data.get('comment') or ''
+
+        if name in ('', '.', '..'):
+            logger.error('No file name provided')
+            return JsonResponse({'error': 'No file name provided'}, status=400)
+
+        # bool is a subclass of int, but true and false are not sizes.
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            logger.error('Invalid file size')
+            return JsonResponse({'error': 'Invalid file size'}, status=400)
+
+        if request.user.available_bytes is not None and size > request.user.available_bytes:
+            logger.error('Upload does not fit in storage quota')
+            return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+
+        if File.objects.filter(user=request.user, original_name=name).exists():
+            logger.error('File with this name already exists')
+            return JsonResponse({'error': 'File with this name already exists'}, status=400)
+
+        logger.debug('Creating upload session...')
+        session = UploadSession(
+            user=request.user,
+            original_name=name,
+            size=size,
+            comment=comment,
+            expires_date=datetime.now(timezone.utc) + timedelta(seconds=settings.FILES_UPLOAD_SESSION_TTL)
+        )
+        os.makedirs(os.path.dirname(session.temp_path), exist_ok=True)
+        with open(session.temp_path, 'wb') as f:
+            f.truncate(size)
+        session.save()
+        logger.debug('Created upload session')
+
+        logger.debug('Exiting UploadSessionsView.post function and responding with "session": session')
+        return JsonResponse({'session': upload_session_data(session)}, status=201)
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class UploadSessionView(View):
+    def get(self, request, session_id):
+        logger.debug('Entering UploadSessionView.get function')
+        session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+        logger.debug('Exiting UploadSessionView.get function and responding with "session": session')
+        return JsonResponse({'session': upload_session_data(session)})
+
+    def put(self, request, session_id):
+        logger.debug('Entering UploadSessionView.put function')
+        session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+
+        if session.expires_date < datetime.now(timezone.utc):
+            logger.error('Upload session expired')
+            return JsonResponse({'error': 'Upload session expired'}, status=410)
+
+        length = request.META.get('CONTENT_LENGTH', '')
+        if not length.isdigit():
+            logger.error('Content-Length required')
+            return JsonResponse({'error': 'Content-Length required'}, status=411)
+        length = int(length)
+
+        if length > settings.FILES_UPLOAD_MAX_CHUNK_SIZE:
+            logger.error('Chunk too large')
+            return JsonResponse({'error': 'Chunk too large'}, status=413)
+
+        content_range = request.META.get('HTTP_CONTENT_RANGE')
+        if content_range:
+            match = CONTENT_RANGE_RE.match(content_range)
+            if not match or int(match.group(2)) - int(match.group(1)) + 1 != length:
+                logger.error('Invalid Content-Range')
+                return JsonResponse({'error': 'Invalid Content-Range'}, status=400)
+            offset = int(match.group(1))
+        else:
+            offset = request.GET.get('offset', '')
+            if not offset.isdigit():
+                logger.error('Chunk offset required')
+                return JsonResponse({'error': 'Chunk offset required'}, status=400)
+            offset = int(offset)
+
+        if offset + length > session.size:
+            logger.error('Chunk exceeds file size')
+            return JsonResponse({'error': 'Chunk exceeds file size'}, status=400)
+
+        if session.completing:
+            logger.error('Upload is being completed')
+            return JsonResponse({'error': 'Upload is being completed'}, status=409)
+
+        logger.debug('Writing chunk at offset %s, %s bytes...', offset, length)
+        written = write_chunk(session.temp_path, offset, request, length)
+        if written != length:
+            logger.error('Incomplete chunk')
+            return JsonResponse({'error': 'Incomplete chunk'}, status=400)
+        logger.debug('Wrote chunk')
+
+        logger.debug('Recording received range...')
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), id=session.id)
+            if session.completing:
+                # Completion started while the chunk was arriving; its copy may or may not hold it.
+                logger.error('Upload is being completed')
+                return JsonResponse({'error': 'Upload is being completed'}, status=409)
+            if length:
+                session.received = merge_range(session.received, offset, offset + length)
+            session.expires_date = datetime.now(timezone.utc) + timedelta(seconds=settings.FILES_UPLOAD_SESSION_TTL)
+            session.save(update_fields=['received', 'expires_date'])
+        logger.debug('Recorded received range')
+
+        logger.debug('Exiting UploadSessionView.put function and responding with "session": session')
+        return JsonResponse({'session': upload_session_data(session)})
+
+    def delete(self, request, session_id):
+        logger.debug('Entering UploadSessionView.delete function')
+        session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+        session.delete()
+        logger.debug('Exiting UploadSessionView.delete function and responding with "message": "Upload cancelled"')
+        return JsonResponse({'message': 'Upload cancelled'})
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class CompleteUploadSessionView(View):
+    def post(self, request, session_id):
+        logger.debug('Entering CompleteUploadSessionView.post function')
+        session = get_object_or_404(UploadSession, id=session_id, user=request.user)
+
+        if not session.is_complete:
+            logger.error('Upload is incomplete')
+            return JsonResponse({'error': 'Upload is incomplete', 'session': upload_session_data(session)},
+                                status=400)
+
+        if File.objects.filter(user=request.user, original_name=session.original_name).exists():
+            logger.error('File with this name already exists')
+            return JsonResponse({'error': 'File with this name already exists'}, status=400)
+
+        # Chunks arriving from now on are refused, and the blob store gets a private copy hashed as it is
+        # written, never the session file itself. The session keeps its file until the File exists, so a
+        # failed completion can be retried.
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), id=session.id)
+            if session.completing:
+                logger.error('Upload is being completed')
+                return JsonResponse({'error': 'Upload is being completed'}, status=409)
+            session.completing = True
+            session.save(update_fields=['completing'])
+
+        staged_name = None
+        try:
+            # Hashing, compressing and uploading to remote storage read the whole file, so they happen
+            # before any row is locked.
+            logger.debug('Copying received file...')
+            stored_path, encoding, digest = hashed_copy(session.temp_path, session.original_name)
+            logger.debug('Copied received file')
+
+            logger.debug('Storing received file...')
+            try:
+                staged_name = Blob.objects.stage(stored_path, digest)
+            finally:
+                remove_files([stored_path])
+            logger.debug('Stored received file')
+
+            logger.debug('Uploaded file saving to DB...')
+            with transaction.atomic():
+                if not UploadSession.objects.select_for_update().filter(id=session.id).exists():
+                    # Cancelled by a concurrent request.
+                    raise Http404('No upload session matches the given query.')
+                uploaded_file = File.objects.create_from_staged(request.user, session.original_name,
+                                                                session.comment, staged_name, digest, session.size,
+                                                                encoding)
+                session.delete()
+        except BaseException as e:
+            if staged_name:
+                delete_stored_in_background([staged_name])
+            UploadSession.objects.filter(id=session.id).update(completing=False)
+            if isinstance(e, QuotaExceeded):
+                logger.error('Upload does not fit in storage quota')
+                return JsonResponse({'error': 'Storage quota exceeded'}, status=413)
+            if isinstance(e, IntegrityError):
+                logger.error('File with this name already exists')
+                return JsonResponse({'error': 'File with this name already exists'}, status=400)
+            raise
+        logger.debug('Uploaded file saved to DB')
+
+        logger.debug('Exiting CompleteUploadSessionView.post function and responding '
+                     'with "message": "File uploaded successfully"')
+        return JsonResponse({'message': 'File uploaded successfully', 'id': uploaded_file.id})
+
+
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class DeleteView(View):
     def delete(self, request, file_id):
@@ -106,11 +331,11 @@ class RenameView(View):
     def patch(self, request, file_id):
         logger.debug('Entering RenameView.patch function')
         logger.debug('Getting file by id...')
-        file = get_object_or_404(File, id=file_id)
+        file = get_object_or_404(File.objects.only('id', 'user_id', 'name'), id=file_id)
 
         logger.debug('Got file')
 
-        if not file.user == request.user and not (request.user.is_admin or request.user.is_superuser):
+        if not file.user_id == request.user.id and not (request.user.is_admin or request.user.is_superuser):
             logger.error('Access denied')
             return JsonResponse({'error': 'Access denied'}, status=403)
 
@@ -120,7 +345,7 @@ class RenameView(View):
             file.name = new_name
             logger.debug('File name changed')
             logger.debug('File saving...')
-            file.save()
+            file.save(update_fields=['name'])
             logger.debug('File saved')
 
             logger.debug('Exiting RenameView.patch function and responding with "message": "File renamed successfully"')
@@ -139,11 +364,11 @@ class CommentView(View):
     def patch(self, request, file_id):
         logger.debug('Entering CommentView.patch function')
         logger.debug('Getting file by id...')
-        file = get_object_or_404(File, id=file_id)
+        file = get_object_or_404(File.objects.only('id', 'user_id', 'comment'), id=file_id)
 
         logger.debug('Got file')
 
-        if not file.user == request.user and not (request.user.is_admin or request.user.is_superuser):
+        if not file.user_id == request.user.id and not (request.user.is_admin or request.user.is_superuser):
             return JsonResponse({'error': 'Access denied'}, status=403)
 
         new_comment = json.loads(request.body).get('comment')
@@ -152,7 +377,7 @@ class CommentView(View):
             file.comment = new_comment
             logger.debug('File comment changed')
             logger.debug('File saving...')
-            file.save()
+            file.save(update_fields=['comment'])
             logger.debug('File saved')
 
             logger.debug('Exiting CommentView.patch function and responding '
@@ -167,59 +392,243 @@ class CommentView(View):
         return render(request, 'index.html')
 
 
+BULK_UPDATE_FIELDS = {'name': 100, 'comment': 200}
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class BulkFilesView(View):
+    def patch(self, request):
+        logger.debug('Entering BulkFilesView.patch function')
+        items = json.loads(request.body).get('files')
+
+        if not isinstance(items, list) or not items:
+            logger.error('Files not provided')
+            return JsonResponse({'error': 'Files not provided'}, status=400)
+
+        if len(items) > settings.FILES_BULK_MAX_ITEMS:
+            logger.error('Too many files')
+            return JsonResponse({'error': f'At most {settings.FILES_BULK_MAX_ITEMS} files per request'}, status=400)
+
+        logger.debug('Validating changes...')
+        changes = {}
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get('id'), int):
+                logger.error('Invalid file item')
+                return JsonResponse({'error': 'Every item needs an integer id'}, status=400)
+            fields = {field: item[field] for field in BULK_UPDATE_FIELDS if field in item}
+            for field, value in fields.items():
+                if not isinstance(value, str) or not value or len(value) > BULK_UPDATE_FIELDS[field]:
+                    logger.error('Invalid %s for file %s', field, item['id'])
+                    return JsonResponse({'error': f'Invalid {field} for file {item["id"]}'}, status=400)
+            changes.setdefault(item['id'], {}).update(fields)
+        updated_fields = sorted({field for fields in changes.values() for field in fields})
+        if not updated_fields:
+            logger.error('Nothing to update')
+            return JsonResponse({'error': 'Nothing to update'}, status=400)
+        logger.debug('Validated changes')
+
+        with transaction.atomic():
+            logger.debug('Getting files by ids...')
+            files = File.objects.filter(id__in=changes).only('id', *updated_fields)
+            if not (request.user.is_admin or request.user.is_superuser):
+                files = files.filter(user=request.user)
+            files = list(files.select_for_update())
+            logger.debug('Got files')
+
+            missing = sorted(set(changes) - {file.id for file in files})
+            if missing:
+                logger.error('Files not found: %s', missing)
+                return JsonResponse({'error': 'Files not found', 'ids': missing}, status=404)
+
+            for file in files:
+                for field, value in changes[file.id].items():
+                    setattr(file, field, value)
+
+            logger.debug('Saving files...')
+            File.objects.bulk_update(files, updated_fields, batch_size=500)
+            logger.debug('Saved files')
+
+        logger.debug('Exiting BulkFilesView.patch function and responding with "message": "Files updated successfully"')
+        return JsonResponse({'message': 'Files updated successfully', 'updated': len(files)})
+
+    def delete(self, request):
+        logger.debug('Entering BulkFilesView.delete function')
+        data = json.loads(request.body)
+        ids = data.get('ids')
+        filters = data.get('filter')
+
+        if ids is not None:
+            if not isinstance(ids, list) or not ids or not all(isinstance(file_id, int) for file_id in ids):
+                logger.error('Invalid ids')
+                return JsonResponse({'error': 'ids must be a non-empty list of integers'}, status=400)
+            if len(ids) > settings.FILES_BULK_MAX_ITEMS:
+                logger.error('Too many files')
+                return JsonResponse({'error': f'At most {settings.FILES_BULK_MAX_ITEMS} files per request'},
+                                    status=400)
+            files = File.objects.filter(id__in=ids)
+            if not (request.user.is_admin or request.user.is_superuser):
+                files = files.filter(user=request.user)
+        elif isinstance(filters, dict) and filters:
+            try:
+                files = File.objects.filter(user=request.user).filter(file_filter_query(filters))
+            except ValueError:
+                logger.error('Invalid filter value')
+                return JsonResponse({'error': 'Invalid filter value'}, status=400)
+        else:
+            logger.error('Neither ids nor filter provided')
+            return JsonResponse({'error': 'Neither ids nor filter provided'}, status=400)
+
+        logger.debug('Getting ids of files to delete...')
+        owned = list(files.order_by('id').values_list('id', flat=True)[:settings.FILES_BULK_MAX_ITEMS + 1])
+        more = len(owned) > settings.FILES_BULK_MAX_ITEMS
+        owned = owned[:settings.FILES_BULK_MAX_ITEMS]
+        logger.debug('Got %s ids of files to delete', len(owned))
+
+        logger.debug('Deleting files...')
+        deleted = set(File.objects.delete_files(owned))
+        logger.debug('Deleted %s files', len(deleted))
+
+        results = [{'id': file_id, 'status': 'deleted' if file_id in deleted else 'not_found'}
+                   for file_id in (ids if ids is not None else owned)]
+
+        logger.debug('Exiting BulkFilesView.delete function and responding with "results": results')
+        return JsonResponse({'results': results, 'more': more})
+
+
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class DownloadView(View):
     def get(self, request, file_id):
         logger.debug('Entering DownloadView.get function')
         logger.debug('Getting file by id...')
-        file = get_object_or_404(File, id=file_id)
+        file = get_object_or_404(File.objects.select_related('blob'), id=file_id)
 
         logger.debug('Got file')
 
-        if file.user != request.user and not (request.user.is_admin or request.user.is_superuser):
+        if file.user_id != request.user.id and not (request.user.is_admin or request.user.is_superuser):
             logger.error('Access denied')
             return JsonResponse({'error': 'Access denied'}, status=403)
-        logger.debug('Updating last_download_date file...')
-        file.last_download_date = datetime.now(timezone.utc)
-        logger.debug('File last_download_date updated')
-        logger.debug('File saving...')
-        file.save()
-        logger.debug('File saved')
 
         logger.debug('Preparing response with file_data...')
-        response = HttpResponse(file.data, content_type='application/octet-stream')
-        response['Content-Disposition'] = f'attachment; filename="{file.original_name}"'
+        response = serve_file(request, file)
         logger.debug('Response with file_data prepared')
 
+        if counts_as_download(request, response, file.size):
+            logger.debug('Recording download...')
+            download_stats.record(file.id)
+
         logger.debug('Exiting DownloadView.get function'
                      ' and responding with file_data application/octet-stream')
         return response
 
 
 class DownloadSpecialView(View):
-    def get(self, request, _, file_id):
+    def get(self, request, file_id, token):
         logger.debug('Entering DownloadSpecialView.get function')
-        logger.debug('Getting file by special_link...')
-        file = get_object_or_404(File, special_link=request.path)
+        logger.debug('Getting file by share_token...')
+        file = get_object_or_404(File.objects.select_related('blob'), share_token=token)
         if file_id == file.id:
             logger.debug('Got file')
 
-            logger.debug('Updating last_download_date file...')
-            file.last_download_date = datetime.now(timezone.utc)
-            logger.debug('File last_download_date updated')
-            logger.debug('File saving...')
-            file.save()
-            logger.debug('File saved')
-
             logger.debug('Preparing response with file_data...')
-            response = HttpResponse(file.data, content_type='application/octet-stream')
-            response['Content-Disposition'] = f'attachment; filename="{file.original_name}"'
+            response = serve_file(request, file)
             logger.debug('Response with file_data prepared')
 
+            if counts_as_download(request, response, file.size):
+                logger.debug('Recording download...')
+                download_stats.record(file.id)
+
             logger.debug('Exiting DownloadSpecialView.get function'
                          ' and responding with file_data application/octet-stream')
             return response
 
+        logger.error('Share token does not match file id')
+        raise Http404('File not found')
+
+
+def usage_data(user):
+    return {
+        'used_bytes': user.used_bytes,
+        'file_count': user.file_count,
+        'quota_bytes': user.quota,
+        'available_bytes': user.available_bytes
+    }
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class UsageView(View):
+    def get(self, request):
+        logger.debug('Entering UsageView.get function')
+        user = request.user
+        user_id = request.GET.get('user_id')
+        if user_id and user_id != str(request.user.id):
+            if not (request.user.is_admin or request.user.is_superuser):
+                logger.error('Access denied')
+                return JsonResponse({'error': 'Access denied'}, status=403)
+            if not user_id.isdigit():
+                logger.error('Invalid user_id')
+                return JsonResponse({'error': 'Invalid user_id'}, status=400)
+            user = get_object_or_404(User.objects.only('used_bytes', 'file_count', 'quota_bytes'), id=user_id)
+
+        logger.debug('Exiting UsageView.get function and responding with "usage": usage')
+        return JsonResponse({'usage': usage_data(user)})
+
+
+ARCHIVE_FILE_FIELDS = ('id', 'user_id', 'original_name', 'path', 'size', 'upload_date', 'blob', 'blob__encoding')
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class ArchiveView(View):
+    """
+    Stream a ZIP of the files given as ?ids=1,2,3, or of all of the user's files
+    (optionally narrowed by the GetFilesView filters) with ?all=1.
+    """
+
+    def get(self, request):
+        logger.debug('Entering ArchiveView.get function')
+        ids = request.GET.get('ids')
+
+        if ids:
+            try:
+                ids = sorted({int(file_id) for file_id in ids.split(',')})
+            except ValueError:
+                logger.error('Invalid ids')
+                return JsonResponse({'error': 'ids must be a comma separated list of integers'}, status=400)
+            if len(ids) > settings.FILES_BULK_MAX_ITEMS:
+                logger.error('Too many files')
+                return JsonResponse({'error': f'At most {settings.FILES_BULK_MAX_ITEMS} files per request'},
+                                    status=400)
+
+            logger.debug('Getting files by ids...')
+            files = File.objects.filter(id__in=ids).select_related('blob').only(*ARCHIVE_FILE_FIELDS)
+            if not (request.user.is_admin or request.user.is_superuser):
+                files = files.filter(user=request.user)
+            files = list(files.order_by('id'))
+            logger.debug('Got files')
+
+            missing = sorted(set(ids) - {file.id for file in files})
+            if missing:
+                logger.error('Files not found: %s', missing)
+                return JsonResponse({'error': 'Files not found', 'ids': missing}, status=404)
+        elif request.GET.get('all') == '1':
+            try:
+                query = file_filter_query(request.GET)
+            except ValueError:
+                logger.error('Invalid filter value')
+                return JsonResponse({'error': 'Invalid filter value'}, status=400)
+            # Read lazily while the archive is being streamed, so the file list is never held in memory.
+            files = (File.objects.filter(user=request.user).filter(query).select_related('blob')
+                     .only(*ARCHIVE_FILE_FIELDS).order_by('id').iterator(chunk_size=500))
+        else:
+            logger.error('Neither ids nor all provided')
+            return JsonResponse({'error': 'Neither ids nor all provided'}, status=400)
+
+        response = StreamingHttpResponse(iter_zip(files, on_file_done=lambda file: download_stats.record(file.id)),
+                                         content_type='application/zip')
+        response['Content-Disposition'] = content_disposition_header(True, 'files.zip')
+
+        logger.debug('Exiting ArchiveView.get function and streaming application/zip')
+        return response
+
 
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class DetailView(View):
@@ -233,18 +642,45 @@ class DetailView(View):
 class NewSpecialLinkView(View):
     def patch(self, request, file_id):
         logger.debug('Entering NewSpecialLinkView.patch function')
-        file = get_object_or_404(File, id=file_id)
-        if not file.user == request.user and not (request.user.is_admin or request.user.is_superuser):
+        file = get_object_or_404(File.objects.only('id', 'user_id', 'share_token'), id=file_id)
+        if not file.user_id == request.user.id and not (request.user.is_admin or request.user.is_superuser):
             logger.error('Access denied')
             return JsonResponse({'error': 'Access denied'}, status=403)
         logger.debug('Deleting old link and saving file with new link...')
-        file.special_link = ''
-        file.save()
+        file.share_token = new_share_token()
+        file.save(update_fields=['share_token'])
         logger.debug('Deleted old link and saved file with new link')
         logger.debug('Exiting NewSpecialLinkView.patch function and rendering page')
         return JsonResponse({'message': 'New special link generated!'})
 
 
+FILE_LIST_SORT_FIELDS = ('upload_date', 'name', 'size', 'last_download_date')
+
+
+def file_filter_query(params):
+    """
+    Q object for the name, min_size, max_size, uploaded_after and uploaded_before
+    filters in params (query parameters or a JSON object). Raises ValueError on
+    malformed values.
+    """
+    query = Q()
+    if params.get('name'):
+        query &= Q(name__icontains=params.get('name'))
+    for param, lookup in (('min_size', 'size__gte'), ('max_size', 'size__lte')):
+        value = str(params.get(param) or '')
+        if value:
+            if not value.isdigit():
+                raise ValueError(f'Invalid {param}')
+            query &= Q(**{lookup: int(value)})
+    if params.get('uploaded_after'):
+        query &= Q(upload_date__gte=datetime.strptime(params.get('uploaded_after'), '%d.%m.%Y')
+                   .replace(tzinfo=timezone.utc))
+    if params.get('uploaded_before'):
+        query &= Q(upload_date__lt=datetime.strptime(params.get('uploaded_before'), '%d.%m.%Y')
+                   .replace(tzinfo=timezone.utc) + timedelta(days=1))
+    return query
+
+
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class GetFilesView(View):
     def get(self, request):
@@ -255,51 +691,108 @@ class GetFilesView(View):
             logger.debug('Admin/Superuser request')
             logger.debug('User finding...')
             user = get_object_or_404(User, id=user_id)
-
-            logger.debug('Preparing File.objects filtered by user...')
-            files = File.objects.filter(user=user)
-            logger.debug('Prepared File.objects filtered by user')
         else:
             logger.debug('User request')
-            logger.debug('Getting files filtered by request.user...')
-            files = File.objects.filter(user=request.user)
-            if files:
-                logger.debug('Got files filtered by request.user')
-            else:
-                logger.debug('Files not found by request.user')
-                logger.debug('Setting files empty...')
-                files = []
-                logger.debug('Set files empty')
+            user = request.user
+
+        sort_field = request.GET.get('sort') or '-upload_date'
+        if sort_field.lstrip('-') not in FILE_LIST_SORT_FIELDS:
+            logger.error('Invalid sort parameter')
+            return JsonResponse({'error': 'Invalid sort parameter'}, status=400)
+
+        try:
+            limit = parse_page_size(request.GET.get('limit'))
+        except ValueError:
+            logger.error('Invalid limit parameter')
+            return JsonResponse({'error': 'Invalid limit parameter'}, status=400)
+
+        logger.debug('Preparing File.objects filtered by user...')
+        files = File.objects.filter(user=user)
+
+        try:
+            files = files.filter(file_filter_query(request.GET))
+        except ValueError:
+            logger.error('Invalid filter value')
+            return JsonResponse({'error': 'Invalid filter value'}, status=400)
+        logger.debug('Prepared File.objects filtered by user')
+
+        logger.debug('Getting files page...')
+        try:
+            files, next_cursor = keyset_page(files.values(*FILE_LIST_FIELDS), sort_field,
+                                             request.GET.get('cursor'), limit)
+        except InvalidCursor:
+            logger.error('Invalid cursor')
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        logger.debug('Got files page')
 
         logger.debug('Starting file_list preparation...')
+        file_list = [file_list_data(file) for file in files]
+        logger.debug('Finished file_list preparation...')
+
+        logger.debug('Exiting GetFilesView.get function, rendering page and responding with "files": file_list object')
+        return JsonResponse({'files': file_list, 'next_cursor': next_cursor})
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class SearchFilesView(View):
+    def get(self, request):
+        logger.debug('Entering SearchFilesView.get function')
+        query = request.GET.get('q', '').strip()
+        if not query:
+            logger.error('Search query not provided')
+            return JsonResponse({'error': 'Search query not provided'}, status=400)
+
+        try:
+            limit = parse_page_size(request.GET.get('limit'))
+        except ValueError:
+            logger.error('Invalid limit parameter')
+            return JsonResponse({'error': 'Invalid limit parameter'}, status=400)
+
+        files = File.objects.all()
+        if request.user.is_admin or request.user.is_superuser:
+            logger.debug('Admin/Superuser request')
+            user_id = request.GET.get('user_id')
+            if user_id and user_id.isdigit():
+                files = files.filter(user_id=int(user_id))
+            elif not request.GET.get('all'):
+                files = files.filter(user=request.user)
+        else:
+            logger.debug('User request')
+            files = files.filter(user=request.user)
+
+        logger.debug('Searching files...')
+        files = search_files(files.values(*FILE_LIST_FIELDS, 'user_id'), query, limit)
         file_list = []
         for file in files:
-            file_data = {
-                "id": file.id,
-                "name": file.name,
-                "comment": file.comment,
-                "size": file.size,
-                "upload_date": str(file.upload_date),
-                "last_download_date": str(file.last_download_date)
-            }
+            file_data = file_list_data(file)
+            file_data['user_id'] = file['user_id']
             file_list.append(file_data)
-        logger.debug('Finished file_list preparation...')
+        logger.debug('Found %s files', len(file_list))
 
-        logger.debug('Exiting GetFilesView.get function, rendering page and responding with "files": file_list object')
+        logger.debug('Exiting SearchFilesView.get function and responding with "files": file_list')
         return JsonResponse({'files': file_list})
 
 
 @method_decorator(login_required(login_url='/login/'), name='dispatch')
 class GetFileView(View):
+    """
+    File metadata with the URLs to fetch its content from. The content itself is
+    only returned when asked for with ?include=content, and then as the raw file
+    like FileContentView does.
+    """
+
     def get(self, request, file_id):
         logger.debug('Entering GetFileView.get function')
+        if request.GET.get('include') == 'content':
+            logger.debug('Content requested, serving file inline')
+            return FileContentView.as_view()(request, file_id=file_id)
+
         logger.debug('Getting file by id...')
-        file = get_object_or_404(File, id=file_id)
+        file = get_object_or_404(File.objects.select_related('blob'), id=file_id)
         logger.debug('Got file')
-        if not file.user == request.user and not (request.user.is_admin or request.user.is_superuser):
+        if file.user_id != request.user.id and not (request.user.is_admin or request.user.is_superuser):
             logger.error('Access denied')
             return JsonResponse({'error': 'Access denied'}, status=403)
-        logger.debug('Popping data field from file...')
         file_obj = {
             'id': file.id,
             'name': file.name,
@@ -308,10 +801,71 @@ class GetFileView(View):
             'size': file.size,
             'upload_date': str(file.upload_date),
             'last_download_date': str(file.last_download_date),
+            'download_count': file.download_count,
             'special_link': file.special_link,
-            'data': base64.b64encode(file.data).decode('utf-8'),
+            'download_url': reverse('file-download', args=[file.id]),
+            'content_url': reverse('file-content', args=[file.id]),
+            'preview_url': preview_url(file.id, file.sha256, file.blob.preview if file.blob else None),
         }
 
-        logger.debug('Popped data field from file')
         logger.debug('Exiting GetFileView.get function and responding with "file": file')
         return JsonResponse({'file': file_obj})
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class FileContentView(View):
+    def get(self, request, file_id):
+        logger.debug('Entering FileContentView.get function')
+        logger.debug('Getting file by id...')
+        file = get_object_or_404(File.objects.select_related('blob'), id=file_id)
+        logger.debug('Got file')
+
+        if file.user_id != request.user.id and not (request.user.is_admin or request.user.is_superuser):
+            logger.error('Access denied')
+            return JsonResponse({'error': 'Access denied'}, status=403)
+
+        # Viewing a file in the UI is not a download, so download stats are left alone.
+        response = serve_file(request, file, as_attachment=False)
+
+        logger.debug('Exiting FileContentView.get function and responding with file content inline')
+        return response
+
+
+@method_decorator(login_required(login_url='/login/'), name='dispatch')
+class PreviewView(View):
+    """
+    The cached thumbnail or text snippet of a file. Previews are keyed by content
+    digest and never change, so they are cacheable for good; listings add the
+    digest to the URL so a changed file gets a new one.
+    """
+
+    def get(self, request, file_id):
+        logger.debug('Entering PreviewView.get function')
+        file = get_object_or_404(File.objects.select_related('blob'), id=file_id)
+
+        if file.user_id != request.user.id and not (request.user.is_admin or request.user.is_superuser):
+            logger.error('Access denied')
+            return JsonResponse({'error': 'Access denied'}, status=403)
+
+        name = file.blob.preview_name if file.blob else None
+        if not name:
+            logger.debug('File %s has no preview', file_id)
+            return JsonResponse({'error': 'No preview'}, status=404)
+
+        etag = f'"preview-{file.sha256}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            try:
+                # Previews are a few kilobytes, read whole whichever storage they are in.
+                with get_storage().open(name) as f:
+                    preview = f.read()
+            except FileNotFoundError:
+                logger.error('Preview of file %s is missing at %s', file_id, name)
+                return JsonResponse({'error': 'No preview'}, status=404)
+            response = HttpResponse(preview, content_type=PREVIEW_CONTENT_TYPES[file.blob.preview])
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, max-age=31536000, immutable'
+        response['X-Content-Type-Options'] = 'nosniff'
+
+        logger.debug('Exiting PreviewView.get function and responding with preview')
+        return response
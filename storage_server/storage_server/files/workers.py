@@ -0,0 +1,68 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from ..logger import logger
+from .storage import get_storage
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_preview_executor = None
+_preview_slots = None
+_preview_pid = None
+
+
+def background_executor():
+    """Thread pool for filesystem work that should not hold up the request, one per process."""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=settings.FILES_IO_WORKERS, thread_name_prefix='files-io')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def submit_preview(fn, *args):
+    """
+    Run fn(*args) on the preview thread pool, one per process, unless
+    FILES_PREVIEW_QUEUE_SIZE jobs are already queued or running there.
+    Returns whether the job was accepted.
+    """
+    global _preview_executor, _preview_slots, _preview_pid
+    with _lock:
+        if _preview_executor is None or _preview_pid != os.getpid():
+            _preview_executor = ThreadPoolExecutor(max_workers=settings.FILES_PREVIEW_WORKERS,
+                                                   thread_name_prefix='files-preview')
+            _preview_slots = threading.BoundedSemaphore(settings.FILES_PREVIEW_QUEUE_SIZE)
+            _preview_pid = os.getpid()
+        executor, slots = _preview_executor, _preview_slots
+    if not slots.acquire(blocking=False):
+        return False
+
+    def run():
+        try:
+            fn(*args)
+        finally:
+            slots.release()
+
+    executor.submit(run)
+    return True
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.exception('Could not remove %s', path)
+
+
+def delete_stored_in_background(names):
+    """Delete the named files from the storage backend on the background pool."""
+    if names:
+        background_executor().submit(get_storage().delete, list(names))
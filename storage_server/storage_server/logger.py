@@ -1,3 +1,129 @@
+import atexit
+import contextvars
 import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 
 logger = logging.getLogger(__name__)
+
+# Whether debug records of the current request are kept, decided once per request by DebugSamplingMiddleware.
+_debug_sampled = contextvars.ContextVar('debug_sampled', default=True)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Hands records to a QueueListener thread that passes them to the handlers of
+    the target logger, so requests never wait on disk or console writes. The
+    queue holds at most about queue_size records; when it is full records are
+    dropped rather than blocking, and a warning with the number dropped is
+    logged once there is room again.
+
+    Meant for dictConfig: configure the real handlers on a logger that nothing
+    logs to directly and name it as target.
+    """
+
+    def __init__(self, target, queue_size=10000):
+        # SimpleQueue is implemented in C and much cheaper per record than queue.Queue.
+        super().__init__(queue.SimpleQueue())
+        self.target = logging.getLogger(target)
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener = None
+        self.start()
+        atexit.register(self.stop)
+        # A forked worker inherits the queue but not the listener thread.
+        os.register_at_fork(after_in_child=self.restart)
+
+    def start(self):
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def restart(self):
+        self.queue = queue.SimpleQueue()
+        self.dropped = 0
+        self.start()
+
+    def prepare(self, record):
+        """
+        Merge the arguments into the message on the calling thread, before the
+        record is queued, as they may change once the call returns, and drop
+        what cannot cross threads. The record is not copied, as nothing else
+        handles it.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # The bound is approximate under concurrent logging, which is fine for keeping memory in check.
+        if self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            return
+        if self.dropped:
+            dropped = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                        'Log queue full, dropped %s records', (self.dropped,), None)
+            self.dropped = 0
+            self.queue.put_nowait(self.prepare(dropped))
+        self.queue.put_nowait(record)
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Drops DEBUG records of requests DebugSamplingMiddleware did not sample. Other levels always pass."""
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or _debug_sampled.get()
+
+
+def sample_debug_logs(rate):
+    """Keep or drop the current context's debug records, keeping a rate fraction of them on average."""
+    return _debug_sampled.set(rate >= 1 or random.random() < rate)
+
+
+class DebugSamplingMiddleware:
+    """
+    Keeps the debug logs of a settings.LOG_DEBUG_SAMPLE_RATE fraction of requests,
+    all or nothing per request so the logs of a sampled request stay complete.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        from django.conf import settings
+
+        self.get_response = get_response
+        self.rate = settings.LOG_DEBUG_SAMPLE_RATE
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = sample_debug_logs(self.rate)
+        try:
+            return self.get_response(request)
+        finally:
+            _debug_sampled.reset(token)
+
+    async def __acall__(self, request):
+        token = sample_debug_logs(self.rate)
+        try:
+            return await self.get_response(request)
+        finally:
+            _debug_sampled.reset(token)
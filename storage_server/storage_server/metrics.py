@@ -0,0 +1,385 @@
+import atexit
+import contextvars
+import fcntl
+import json
+import os
+import secrets
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, JsonResponse
+from django.views import View
+
+from .logger import logger
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Seconds; request latencies range from cached listings to multi-gigabyte uploads.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+METRICS = {
+    'storage_http_requests_total': (COUNTER, 'Requests handled, by view, method and status code.'),
+    'storage_http_request_duration_seconds': (HISTOGRAM, 'Time until the response is ready, by view and method.'),
+    'storage_http_request_bytes_total': (COUNTER, 'Request body bytes received, by view.'),
+    'storage_http_response_bytes_total': (COUNTER, 'Response body bytes sent, by view.'),
+    'storage_http_requests_in_progress': (GAUGE, 'Requests being handled or sending their response.'),
+    'storage_http_transfers_in_flight': (GAUGE, 'Streamed responses being sent, by view.'),
+    'storage_db_queries_total': (COUNTER, 'Database queries run while handling requests, by view.'),
+    'storage_db_query_duration_seconds_total': (COUNTER, 'Time spent in database queries, by view.'),
+}
+
+# Query count and seconds of the request being handled in this context, shared with sync_to_async threads.
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+class Registry:
+    """
+    The metrics of this process. Each process periodically writes them to its
+    own file under METRICS_DIRECTORY, and the metrics endpoint adds up the files
+    of all processes, so any worker can answer a scrape.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.histograms = {}
+        self.dirty = False
+        self.pid = None
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.values[name, labels] += value
+            self.dirty = True
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                # Per-bucket (not cumulative) counts, then the +Inf bucket, the sum and the count.
+                histogram = self.histograms[name, labels] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0, 0]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    break
+            else:
+                index = len(LATENCY_BUCKETS)
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+            self.dirty = True
+
+    def snapshot(self):
+        with self.lock:
+            self.dirty = False
+            return {
+                'values': [[name, list(labels), value] for (name, labels), value in self.values.items()],
+                'histograms': [[name, list(labels), list(histogram)]
+                               for (name, labels), histogram in self.histograms.items()]
+            }
+
+    def flush(self):
+        """Write this process's metrics to its file, atomically."""
+        directory = settings.METRICS_DIRECTORY
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-', suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temp_path, os.path.join(directory, f'metrics-{os.getpid()}.json'))
+
+    def ensure_flusher(self):
+        """Start the thread flushing changed metrics every METRICS_FLUSH_INTERVAL seconds, once per process."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # Forked from a process that already recorded metrics; those are its own.
+                self.values.clear()
+                self.histograms.clear()
+            self.pid = os.getpid()
+        threading.Thread(target=self.run_flusher, name='metrics-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def run_flusher(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            if self.dirty:
+                try:
+                    self.flush()
+                except OSError:
+                    logger.exception('Could not write metrics')
+
+
+registry = Registry()
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding each query's count and time to the request being handled."""
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - started
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_wrapper)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class else match.url_name or match.func.__name__
+
+
+class MetricsMiddleware:
+    """
+    Records per-view latency, status, body sizes and database queries of every
+    request, and the requests in progress and streamed responses in flight.
+    A response counts as finished when the server closes it, after its body
+    was sent.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        # Connections opened later get the wrapper from the connection_created signal.
+        for connection in connections.all(initialized_only=True):
+            install_query_wrapper(None, connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started, queries, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        return self.finish(request, response, started, queries)
+
+    async def __acall__(self, request):
+        started, queries, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        return self.finish(request, response, started, queries)
+
+    @staticmethod
+    def start():
+        registry.ensure_flusher()
+        registry.inc('storage_http_requests_in_progress', ())
+        queries = [0, 0.0]
+        return time.perf_counter(), queries, _request_queries.set(queries)
+
+    def finish(self, request, response, started, queries):
+        view = view_name(request)
+        labels = (('view', view),)
+        registry.observe('storage_http_request_duration_seconds', (('method', request.method),) + labels,
+                         time.perf_counter() - started)
+        registry.inc('storage_http_requests_total',
+                     (('method', request.method), ('status', str(response.status_code))) + labels)
+        registry.inc('storage_db_queries_total', labels, queries[0])
+        registry.inc('storage_db_query_duration_seconds_total', labels, queries[1])
+        request_bytes = request.META.get('CONTENT_LENGTH')
+        if request_bytes and request_bytes.isdigit():
+            registry.inc('storage_http_request_bytes_total', labels, int(request_bytes))
+
+        sent = [0]
+        content_length = response.get('Content-Length')
+        if not response.streaming:
+            sent[0] = len(response.content)
+        elif content_length and content_length.isdigit():
+            sent[0] = int(content_length)
+        elif response.is_async:
+            response.streaming_content = self.acount(response.streaming_content, sent)
+        else:
+            response.streaming_content = self.count(response.streaming_content, sent)
+        if response.streaming:
+            registry.inc('storage_http_transfers_in_flight', labels)
+
+        close = response.close
+        closed = []
+
+        def finished():
+            try:
+                close()
+            finally:
+                # Some servers and the test client close responses more than once.
+                if not closed:
+                    closed.append(True)
+                    registry.inc('storage_http_response_bytes_total', labels, sent[0])
+                    registry.inc('storage_http_requests_in_progress', (), -1)
+                    if response.streaming:
+                        registry.inc('storage_http_transfers_in_flight', labels, -1)
+
+        # Servers close the response once it is sent; WSGI file wrappers call it through file_to_stream.
+        response.close = finished
+        return response
+
+    @staticmethod
+    def count(content, sent):
+        for chunk in content:
+            sent[0] += len(chunk)
+            yield chunk
+
+    @staticmethod
+    async def acount(content, sent):
+        async for chunk in content:
+            sent[0] += len(chunk)
+            yield chunk
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def merge(totals, snapshot, include_gauges=True):
+    for name, labels, value in snapshot['values']:
+        if include_gauges or METRICS[name][0] != GAUGE:
+            totals['values'][name, tuple(map(tuple, labels))] += value
+    for name, labels, histogram in snapshot['histograms']:
+        key = name, tuple(map(tuple, labels))
+        current = totals['histograms'].setdefault(key, [0] * len(histogram))
+        for index, value in enumerate(histogram):
+            current[index] += value
+
+
+def collect():
+    """
+    Add up the metric files of all processes. Files of processes that exited
+    are folded into archived.json, keeping their counters but not their gauges,
+    so the directory does not grow with worker restarts.
+    """
+    registry.flush()
+    directory = settings.METRICS_DIRECTORY
+    totals = {'values': defaultdict(float), 'histograms': {}}
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, 'archived.json')
+        archive = {'values': defaultdict(float), 'histograms': {}}
+        try:
+            with open(archive_path) as f:
+                merge(archive, json.load(f))
+        except FileNotFoundError:
+            pass
+        archived = False
+        for name in os.listdir(directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if pid_alive(int(name[len('metrics-'):-len('.json')])):
+                merge(totals, snapshot)
+            else:
+                merge(archive, snapshot, include_gauges=False)
+                os.remove(path)
+                archived = True
+        if archived:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.archived-', suffix='.part')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'values': [[name, list(labels), value] for (name, labels), value in archive['values'].items()],
+                    'histograms': [[name, list(labels), histogram]
+                                   for (name, labels), histogram in archive['histograms'].items()]
+                }, f)
+            os.replace(temp_path, archive_path)
+    merge(totals, {
+        'values': [[name, labels, value] for (name, labels), value in archive['values'].items()],
+        'histograms': [[name, labels, histogram] for (name, labels), histogram in archive['histograms'].items()]
+    })
+    return totals
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{key}="{value.replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(totals):
+    """The totals in the Prometheus text exposition format."""
+    lines = []
+    values = defaultdict(list)
+    for (name, labels), value in totals['values'].items():
+        values[name].append((labels, value))
+    histograms = defaultdict(list)
+    for (name, labels), histogram in totals['histograms'].items():
+        histograms[name].append((labels, histogram))
+
+    for name, (kind, description) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == HISTOGRAM:
+            for labels, histogram in sorted(histograms[name]):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(histogram[-2])}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram[-1]}')
+        else:
+            for labels, value in sorted(values[name]):
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsView(View):
+    """
+    Metrics of all worker processes in the Prometheus text format. Scrapers
+    authenticate with 'Authorization: Bearer <METRICS_TOKEN>'; admins logged in
+    to the site can look at it too.
+    """
+
+    def get(self, request):
+        logger.debug('Entering MetricsView.get function')
+        token = settings.METRICS_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        # compare_digest() only takes ASCII strings, and headers may carry any byte.
+        authorized = bool(token) and secrets.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+        if not authorized and not (request.user.is_authenticated
+                                   and (request.user.is_admin or request.user.is_superuser)):
+            logger.error('Access denied')
+            return JsonResponse({'error': 'Access denied'}, status=403)
+
+        response = HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+        logger.debug('Exiting MetricsView.get function and responding with metrics')
+        return response
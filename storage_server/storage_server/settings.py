@@ -55,12 +55,15 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'storage_server.accounts',
     'storage_server.files'
 ]
 
 MIDDLEWARE = [
+    'storage_server.metrics.MetricsMiddleware',
+    'storage_server.logger.DebugSamplingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django_session_timeout.middleware.SessionTimeoutMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -110,21 +113,139 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 MEDIA_URL = '/media/'
 
+# Stored contents and previews are fanned out over FILES_SHARD_DEPTH directory levels named after
+# FILES_SHARD_WIDTH hex characters of their digest each. After changing these, run the relocate_media
+# command to move existing files to the new layout.
+FILES_SHARD_DEPTH = env.int('FILES_SHARD_DEPTH', default=2)
+FILES_SHARD_WIDTH = env.int('FILES_SHARD_WIDTH', default=2)
+
+# Where stored files live: 'local' keeps them under MEDIA_ROOT, 's3' in an S3-compatible bucket
+# (requires boto3, see requirements-s3.txt). Uploads are always received into MEDIA_ROOT first.
+FILES_STORAGE_BACKEND = env('FILES_STORAGE_BACKEND', default='local')
+
+# S3 backend. FILES_S3_ENDPOINT_URL points it at MinIO or another S3 clone, which usually also need
+# 'path' addressing. Credentials left empty are taken from the usual AWS environment and config files.
+FILES_S3_BUCKET = env('FILES_S3_BUCKET', default='')
+FILES_S3_PREFIX = env('FILES_S3_PREFIX', default='')
+FILES_S3_ENDPOINT_URL = env('FILES_S3_ENDPOINT_URL', default='')
+FILES_S3_REGION = env('FILES_S3_REGION', default='')
+FILES_S3_ACCESS_KEY_ID = env('FILES_S3_ACCESS_KEY_ID', default='')
+FILES_S3_SECRET_ACCESS_KEY = env('FILES_S3_SECRET_ACCESS_KEY', default='')
+FILES_S3_ADDRESSING_STYLE = env('FILES_S3_ADDRESSING_STYLE', default='auto')
+
+# Files larger than FILES_S3_MULTIPART_CHUNK_SIZE are uploaded in parts of that size,
+# FILES_S3_MAX_CONCURRENCY of them at a time.
+FILES_S3_MULTIPART_CHUNK_SIZE = env.int('FILES_S3_MULTIPART_CHUNK_SIZE', default=16 * 2 ** 20)
+FILES_S3_MAX_CONCURRENCY = env.int('FILES_S3_MAX_CONCURRENCY', default=8)
+
+# Seconds presigned download URLs stay valid in FILES_SERVE_MODE 'redirect'.
+FILES_S3_PRESIGNED_EXPIRY = env.int('FILES_S3_PRESIGNED_EXPIRY', default=300)
+
+# Resumable upload sessions expire this many seconds after their last received chunk
+# and are then removed by the purge_upload_sessions command.
+FILES_UPLOAD_SESSION_TTL = env.int('FILES_UPLOAD_SESSION_TTL', default=24 * 60 * 60)
+
+FILES_UPLOAD_MAX_CHUNK_SIZE = env.int('FILES_UPLOAD_MAX_CHUNK_SIZE', default=64 * 2 ** 20)
+
+# Default and maximum number of files returned per page by the file listing endpoints.
+FILES_PAGE_SIZE = env.int('FILES_PAGE_SIZE', default=100)
+
+FILES_MAX_PAGE_SIZE = env.int('FILES_MAX_PAGE_SIZE', default=1000)
+
+# Maximum number of files a single bulk request may change.
+FILES_BULK_MAX_ITEMS = env.int('FILES_BULK_MAX_ITEMS', default=1000)
+
+# Storage quota per user in bytes, for users without their own quota_bytes. 0 means unlimited.
+FILES_DEFAULT_QUOTA = env.int('FILES_DEFAULT_QUOTA', default=0)
+
+# Compression at rest for new uploads: 'off', 'gzip', 'zstd' (needs zstandard, see requirements-zstd.txt)
+# or 'auto' (zstd when zstandard is installed, gzip otherwise).
+FILES_COMPRESSION = env('FILES_COMPRESSION', default='off')
+
+# Fraction a file's first 256 KiB must shrink by, compressed at the fastest level, for the file to be compressed.
+FILES_COMPRESSION_MIN_SAVING = env.float('FILES_COMPRESSION_MIN_SAVING', default=0.2)
+
+# Threads rendering previews after uploads, per process, and how many preview jobs may wait for them.
+# Uploads beyond that get their preview from the generate_previews command. Image thumbnails and PDF
+# previews need Pillow and pypdf (see requirements-previews.txt); without them only text files get one.
+FILES_PREVIEW_WORKERS = env.int('FILES_PREVIEW_WORKERS', default=2)
+FILES_PREVIEW_QUEUE_SIZE = env.int('FILES_PREVIEW_QUEUE_SIZE', default=200)
+
+# Longest side of image thumbnails in pixels, and length of text previews in characters.
+FILES_PREVIEW_SIZE = env.int('FILES_PREVIEW_SIZE', default=256)
+FILES_PREVIEW_TEXT_CHARS = env.int('FILES_PREVIEW_TEXT_CHARS', default=1000)
+
+# Largest compressed image or PDF read into memory to render its preview.
+FILES_PREVIEW_MAX_SOURCE_SIZE = env.int('FILES_PREVIEW_MAX_SOURCE_SIZE', default=50 * 2 ** 20)
+
+# Threads per worker process for background filesystem work such as unlinking deleted files.
+FILES_IO_WORKERS = env.int('FILES_IO_WORKERS', default=4)
+
+# Downloads are counted in memory and written to File.last_download_date/download_count
+# in batches every FILES_DOWNLOAD_STATS_FLUSH_INTERVAL seconds, or once this many files are pending.
+FILES_DOWNLOAD_STATS_FLUSH_INTERVAL = env.float('FILES_DOWNLOAD_STATS_FLUSH_INTERVAL', default=5.0)
+
+FILES_DOWNLOAD_STATS_MAX_PENDING = env.int('FILES_DOWNLOAD_STATS_MAX_PENDING', default=1000)
+
+# How file downloads are sent: 'django' streams them through wsgi.file_wrapper (sendfile),
+# 'x-accel-redirect' (nginx) and 'x-sendfile' (Apache, lighttpd) hand the transfer to the front proxy,
+# 'redirect' sends clients to presigned URLs of the s3 storage backend.
+FILES_SERVE_MODE = env('FILES_SERVE_MODE', default='django')
+
+# Internal nginx location mapped to MEDIA_ROOT, used in 'x-accel-redirect' mode, e.g.
+#   location /protected-media/ { internal; alias /path/to/media/; }
+FILES_ACCEL_REDIRECT_PREFIX = env('FILES_ACCEL_REDIRECT_PREFIX', default='/protected-media/')
+
+# Route uploads and downloads to the async views. Enable when serving through ASGI (uvicorn),
+# leave off under WSGI (gunicorn), where async views would each need their own event loop.
+FILES_ASYNC_VIEWS = env.bool('FILES_ASYNC_VIEWS', default=False)
+
+# Each worker process writes its request metrics to a file in METRICS_DIRECTORY every
+# METRICS_FLUSH_INTERVAL seconds, and /metrics/ adds them up. The directory must be local to the host.
+METRICS_DIRECTORY = env('METRICS_DIRECTORY', default=os.path.join(BASE_DIR, 'metrics'))
+METRICS_FLUSH_INTERVAL = env.float('METRICS_FLUSH_INTERVAL', default=1.0)
+
+# Bearer token Prometheus sends to read /metrics/. Without one only logged in admins can read it.
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Log levels of the storage_server logger and of its console and file outputs, DEBUG by default only
+# when DEBUG is on. LOG_DEBUG_SAMPLE_RATE keeps the debug logs of that fraction of requests, e.g. 0.01.
+LOG_LEVEL = env('LOG_LEVEL', default='DEBUG' if DEBUG else 'INFO')
+LOG_CONSOLE_LEVEL = env('LOG_CONSOLE_LEVEL', default=LOG_LEVEL)
+LOG_FILE_LEVEL = env('LOG_FILE_LEVEL', default=LOG_LEVEL)
+LOG_DEBUG_SAMPLE_RATE = env.float('LOG_DEBUG_SAMPLE_RATE', default=1.0)
+
+# Records most waiting to be written before new ones are dropped.
+LOG_QUEUE_SIZE = env.int('LOG_QUEUE_SIZE', default=10000)
+
+# Records are handed to a background thread by the queue handler and written to the console and the
+# log file from there, off the request thread.
 LOGGING = {
    'version': 1,
    'disable_existing_loggers': False,
+   'filters': {
+       'debug_sampling': {
+           '()': 'storage_server.logger.DebugSamplingFilter',
+       },
+   },
    'handlers': {
        'console': {
-           'level': 'DEBUG',
+           'level': LOG_CONSOLE_LEVEL,
            'class': 'logging.StreamHandler',
            'formatter': 'simple',
        },
        'file': {
-           'level': 'DEBUG',
+           'level': LOG_FILE_LEVEL,
            'class': 'logging.FileHandler',
            'formatter': 'simple',
            'filename': create_log_directory.create_log_directory(),
        },
+       'queue': {
+           '()': 'storage_server.logger.BackgroundQueueHandler',
+           'target': 'storage_server.log_writer',
+           'queue_size': LOG_QUEUE_SIZE,
+           'filters': ['debug_sampling'],
+       },
    },
    'formatters': {
        'simple': {
@@ -133,8 +254,13 @@ LOGGING = {
    },
    'loggers': {
        'storage_server': {
+           'handlers': ['queue'],
+           'level': LOG_LEVEL,
+       },
+       'storage_server.log_writer': {
            'handlers': ['file', 'console'],
            'level': 'DEBUG',
+           'propagate': False,
        },
    },
 }
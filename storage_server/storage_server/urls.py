@@ -1,9 +1,11 @@
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from .metrics import MetricsView
 
 urlpatterns = [
     path('', include('storage_server.accounts.urls')),
     path('files/', include('storage_server.files.urls')),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT) \
   + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)